@@ -1,8 +1,10 @@
 from flask.helpers import make_response
 from main import app, db, jwt
+from database import mark_written, read_only, replica_reads, run_read_only
+from metrics import timed
 from models.users import User
 from models.roles import Role
-from flask import request, jsonify
+from flask import request, jsonify, Response, stream_with_context
 from schemas.user import (
     UserRegisterSchema,
     UserLoginSchema,
@@ -12,21 +14,31 @@ from schemas.user import (
 )
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound     
-from werkzeug.security import generate_password_hash, check_password_hash
+from .identity import current_user
+from .queries import user_by_username
+from .hashing import hash_password, verify_password, needs_rehash, HashingUnavailable
 from .utils import (
-    add_token_to_database, 
+    add_tokens_to_database,
+    issue_token,
+    role_claims,
+    role_version_cache,
     revoke_token, 
+    revoke_all_tokens,
+    add_revoke_all_event,
+    watermark_cache,
     is_token_revoked,
+    warm_shared_revocations,
+    start_revocation_sync,
     admin_required
 )
 from flask_jwt_extended import (
-    create_access_token,
-    create_refresh_token,
     jwt_required,
     get_jwt_identity,
     get_jwt
 )
 from marshmallow import ValidationError
+from datetime import datetime
+import json
 import uuid
 
 def insert_user_data(data,role_name):
@@ -37,7 +49,7 @@ def insert_user_data(data,role_name):
             email = data['email'],
             name = data['name'],
             role_id = role.id,
-            password = generate_password_hash(data['password']),
+            password = hash_password(data['password']),
         )
         db.session.add(new_user)
         db.session.commit()
@@ -67,6 +79,10 @@ def insert_user_data(data,role_name):
             }
         }
 
+    except HashingUnavailable:
+        db.session.rollback()
+        raise
+
     except Exception as err_exception:
         db.session.rollback()
         response = {
@@ -78,6 +94,20 @@ def insert_user_data(data,role_name):
         }
     return response
 
+def dump(schema, obj):
+    with timed('serialization'):
+        return schema.dump(obj)
+
+def user_not_found():
+    response = {
+        'status': 'fail',
+        'code': 401,
+        'data': {
+            'error': 'user not found'
+        }
+    }
+    return make_response(jsonify(response), 401)
+
 @app.route('/api/v1/accounts/register', methods=['POST'])
 def register():
     data = request.json
@@ -104,7 +134,7 @@ def login():
         UserLoginSchema().load(request.json)
         username = request.json['username']
         password = request.json['password']
-        user_login = User.query.filter_by(username=username).first()
+        user_login = user_by_username(username)
 
         if not user_login:
             response = {
@@ -116,12 +146,18 @@ def login():
             }
             return make_response(jsonify(response), 422)
         
-        check = check_password_hash(user_login.password, password)
+        check = verify_password(user_login.password, password)
         if check:
-            access_token = create_access_token(identity=user_login.uuid)
-            refresh_token = create_refresh_token(identity=user_login.uuid)
-            add_token_to_database(access_token, app.config["JWT_IDENTITY_CLAIM"])
-            add_token_to_database(refresh_token, app.config["JWT_IDENTITY_CLAIM"])
+            if needs_rehash(user_login.password):
+                # stored with outdated parameters, upgrade while we know the password
+                try:
+                    user_login.password = hash_password(password)
+                except HashingUnavailable:
+                    pass
+            claims = role_claims(user_login)
+            access_token, access_record = issue_token(user_login.uuid, 'access', claims)
+            refresh_token, refresh_record = issue_token(user_login.uuid, 'refresh')
+            add_tokens_to_database([access_record, refresh_record])
             response = {
                 'status': 'ok',
                 'code': 200,
@@ -154,9 +190,14 @@ def login():
 @app.route('/api/v1/accounts/logout', methods=['DELETE'])
 @jwt_required()
 def logout():
-    jti = get_jwt()["jti"]
+    jwt_payload = get_jwt()
     user_identity = get_jwt_identity()
-    revoke_token(jti, user_identity)
+    revoke_token(
+        jwt_payload["jti"],
+        user_identity,
+        token_type=jwt_payload["type"],
+        expires=datetime.fromtimestamp(jwt_payload["exp"]),
+    )
     response = {
         'status': 'ok',
         'code': 200,
@@ -164,23 +205,40 @@ def logout():
     }
     return make_response(jsonify(response), 200) 
 
+@app.route('/api/v1/accounts/logout-all', methods=['DELETE'])
+@jwt_required()
+def logout_all():
+    revoke_all_tokens(get_jwt_identity())
+    response = {
+        'status': 'ok',
+        'code': 200,
+        'data': 'All tokens of the user have been revoked'
+    }
+    return make_response(jsonify(response), 200)
+
 @app.route('/api/v1/accounts/me', methods=['GET'])
 @jwt_required()
+@read_only(db, sticky_key=get_jwt_identity)
 def me():
-    user_identity = get_jwt_identity()
-    user_data = User.query.filter_by(uuid=user_identity).first()
+    user_data = current_user()
+    if user_data is None:
+        return user_not_found()
     response = {
         'status': 'ok',
         'code': 200,
-        'data': UsersResponse().dump(user_data)
+        'data': dump(UsersResponse(), user_data)
     }
     return make_response(jsonify(response), 200) 
 
 @app.route('/api/v1/accounts/refresh', methods=['POST'])
 @jwt_required(refresh=True)
 def refresh_token():
-    current_user = get_jwt_identity()
-    access_token = create_access_token(identity=current_user)
+    user_identity = get_jwt_identity()
+    user = current_user()
+    if user is None:
+        return user_not_found()
+    claims = role_claims(user)
+    access_token, access_record = issue_token(user_identity, 'access', claims)
     response = {
         'status': 'ok',
         'code': 200,
@@ -188,19 +246,94 @@ def refresh_token():
             'access_token': access_token
         }
     }
-    add_token_to_database(access_token, app.config["JWT_IDENTITY_CLAIM"])
+    add_tokens_to_database([access_record])
     return make_response(jsonify(response), 200)
  
+@app.route('/api/v1/users/revoke-all', methods=['POST'])
+@admin_required()
+def users_revoke_all():
+    uuid_user = (request.json or {}).get('uuid')
+    if not uuid_user:
+        response = {
+            'status': 'fail',
+            'code': 422,
+            'data': {
+                'error': 'uuid null'
+            }
+        }
+        return make_response(jsonify(response), 422)
+    if not revoke_all_tokens(uuid_user):
+        response = {
+            'status': 'fail',
+            'code': 404,
+            'data': {
+                'error': 'user not found'
+            }
+        }
+        return make_response(jsonify(response), 404)
+    response = {
+        'status': 'ok',
+        'code': 200,
+    }
+    return make_response(jsonify(response), 200)
+
+def stream_users(cursor):
+    """Stream every user after ``cursor`` as one JSON document
+
+    Rows come from a server-side cursor in ``USERS_STREAM_BATCH`` sized
+    batches and are written out as they are fetched, so memory does not
+    grow with the size of the table.
+    """
+    batch_size = app.config['USERS_STREAM_BATCH']
+
+    def generate():
+        schema = UsersResponse()
+        query = User.query.filter(User.id > cursor).order_by(User.id).yield_per(batch_size)
+        yield '{"status": "ok", "code": 200, "data": ['
+        separator = ''
+        with replica_reads():
+            for user in query:
+                yield separator + json.dumps(schema.dump(user))
+                separator = ','
+        yield ']}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
 @app.route('/api/v1/users', methods=['GET', 'POST', 'DELETE', 'PATCH'])
 @admin_required()
 def users():
     if request.method == 'GET':
-        users = User.query.all()
-        users_json = UsersResponse(many=True).dump(users)
+        try:
+            limit = int(request.args.get('limit', app.config['USERS_PAGE_LIMIT']))
+            cursor = int(request.args.get('cursor', 0))
+            if limit < 1:
+                raise ValueError
+        except ValueError:
+            response = {
+                'status': 'fail',
+                'code': 422,
+                'data': {
+                    'error': 'limit/cursor must be positive integers'
+                }
+            }
+            return make_response(jsonify(response), 422)
+
+        if request.args.get('stream') in ('1', 'true'):
+            return stream_users(cursor)
+
+        limit = min(limit, app.config['USERS_PAGE_MAX_LIMIT'])
+        # keyset pagination, one extra row tells us whether a next page exists
+        users = run_read_only(
+            db,
+            lambda: User.query.filter(User.id > cursor).order_by(User.id).limit(limit + 1).all()
+        )
+        next_cursor = str(users[limit - 1].id) if len(users) > limit else None
+        users_json = dump(UsersResponse(many=True), users[:limit])
         response = {
             'status': 'ok',
             'code': 200,
-            'data': users_json
+            'data': users_json,
+            'next': next_cursor
         }
         return make_response(jsonify(response), 200)
     
@@ -237,7 +370,11 @@ def users():
                 user = User.query.filter_by(uuid=uuid_user).one()
                
                 db.session.delete(user)
+                # its tokens are rejected from now on (tokens_valid_after)
+                add_revoke_all_event(uuid_user)
                 db.session.commit()
+                watermark_cache.invalidate(uuid_user)
+                mark_written(app, uuid_user)
                 response = {
                     'status': 'ok',
                     'code': 200,
@@ -265,15 +402,35 @@ def users():
                     update_user.name = request.json['name']
 
                 if 'password' in request.json:
-                    update_user.password = generate_password_hash(request.json['password'])
+                    update_user.password = hash_password(request.json['password'])
+
+                if 'role_name' in request.json:
+                    role = Role.query.filter_by(name=request.json['role_name']).first()
+                    if not role:
+                        db.session.rollback()
+                        response = {
+                            'status': 'fail',
+                            'code': 422,
+                            'data': {
+                                'error': 'role not found'
+                            }
+                        }
+                        return make_response(jsonify(response), response['code'])
+                    update_user.set_role(role)
                 
                 db.session.commit()
+                role_version_cache.invalidate(uuid_user)
+                mark_written(app, uuid_user)
                 response = {
                     'status': 'ok',
                     'code': 200,
                 }
                 return make_response(jsonify(response), response['code'])
-                
+
+            except HashingUnavailable:
+                db.session.rollback()
+                raise
+
             except Exception as err:
                 response = {
                     'status': 'fail',
@@ -292,10 +449,8 @@ def users():
                 }
             }
             return make_response(jsonify(response), response['code'])
-@jwt.user_lookup_loader
-def user_loader_callback(jwt_headers, jwt_payload):
-    identity = jwt_payload["sub"]
-    return User.query.filter_by(uuid=identity).one()
+app.before_first_request(warm_shared_revocations)
+app.before_first_request(start_revocation_sync)
 
 @jwt.token_in_blocklist_loader
 def check_if_token_revoked(jwt_headers, jwt_payload):
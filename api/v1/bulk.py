@@ -0,0 +1,261 @@
+"""Bulk user import and export
+
+Rows are read one at a time from a CSV or NDJSON stream, validated with
+``UserRegisterAdminSchema`` and inserted ``batch_size`` at a time with one
+multi-row insert per batch. Roles are resolved once up front and the
+passwords of a batch are hashed across a process pool. A row that fails
+(validation, column lengths, a duplicate or any other database error) is
+reported to ``reject`` and the rest of its batch is still imported.
+
+Exports walk ``users`` in id order through a server-side cursor and are
+written out row by row, so memory does not depend on the table size. Every
+exported row carries its ``id``; pass the last one as ``after_id`` to
+resume an interrupted export.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import io
+import json
+import uuid
+import zlib
+
+from flask.helpers import make_response
+from flask import request, jsonify, Response, stream_with_context
+from marshmallow import ValidationError
+from sqlalchemy.exc import StatementError
+
+from main import app, db
+from models.roles import Role
+from models.users import User
+from schemas.user import UserRegisterAdminSchema
+from .hashing import hash_many, hashing_service
+from .utils import admin_required
+
+
+# checked before inserting: MySQL fails the whole batch on a value too long
+COLUMN_LENGTHS = {field: User.__table__.c[field].type.length for field in ('username', 'email', 'name')}
+
+
+def too_long(row):
+    """Validation messages for the values longer than their column, or None"""
+    errors = {field: ['Longer than maximum length {}.'.format(length)]
+              for field, length in COLUMN_LENGTHS.items()
+              if len(row.get(field) or '') > length}
+    return errors or None
+
+
+def database_error(err):
+    # the driver's message, err.orig.args[0] is only a numeric code on MySQL
+    return str(getattr(err, 'orig', None) or err)
+
+
+def read_rows(stream, fmt):
+    """Yield ``(line_number, row)``, row is None for an unparsable line"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_number, None
+            continue
+        yield line_number, row if isinstance(row, dict) else None
+
+
+def import_users(stream, fmt='ndjson', batch_size=1000, workers=0, reject=None, max_rows=None):
+    """Import users from ``stream``, returns imported/rejected counts
+
+    ``reject(line_number, row, error)`` is called for every row that is
+    not imported. With ``max_rows`` reading stops after that many rows;
+    ``next_line`` in the result is then the first line left out.
+    """
+    reject = reject or (lambda line_number, row, error: None)
+    schema = UserRegisterAdminSchema()
+    roles = {role.name: role.id for role in Role.query.all()}
+    stats = {'imported': 0, 'rejected': 0, 'next_line': None}
+
+    def rejected(line_number, row, error):
+        stats['rejected'] += 1
+        reject(line_number, row, error)
+
+    def flush(batch, pool):
+        passwords = hash_many([row['password'] for _, row in batch],
+                              hashing_service.method, pool=pool)
+        mappings = [{
+            'uuid': uuid.uuid4().hex,
+            'username': row['username'],
+            'email': row['email'],
+            'name': row['name'],
+            'role_id': roles[row['role_name']],
+            'password': password,
+        } for (_, row), password in zip(batch, passwords)]
+        try:
+            db.session.execute(User.__table__.insert(), mappings)
+            db.session.commit()
+            stats['imported'] += len(mappings)
+        except StatementError:
+            db.session.rollback()
+            # find the offending rows, one insert each
+            for (line_number, row), mapping in zip(batch, mappings):
+                try:
+                    db.session.execute(User.__table__.insert(), mapping)
+                    db.session.commit()
+                    stats['imported'] += 1
+                except StatementError as err:
+                    db.session.rollback()
+                    rejected(line_number, row, database_error(err))
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers else None
+    try:
+        batch = []
+        read = 0
+        for line_number, row in read_rows(stream, fmt):
+            if max_rows is not None and read >= max_rows:
+                stats['next_line'] = line_number
+                break
+            read += 1
+            if row is None:
+                rejected(line_number, None, 'unparsable row')
+                continue
+            try:
+                schema.load(row, unknown='exclude')
+            except ValidationError as err:
+                rejected(line_number, row, err.messages)
+                continue
+            errors = too_long(row)
+            if errors:
+                rejected(line_number, row, errors)
+                continue
+            if row['role_name'] not in roles:
+                rejected(line_number, row, 'role not found')
+                continue
+            batch.append((line_number, row))
+            if len(batch) >= batch_size:
+                flush(batch, pool)
+                batch = []
+        if batch:
+            flush(batch, pool)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return stats
+
+
+def without_password(row):
+    if row is None:
+        return None
+    return {key: value for key, value in row.items() if key != 'password'}
+
+
+@app.route('/api/v1/users/import', methods=['POST'])
+@admin_required()
+def users_import():
+    """Import users from a text/csv or application/x-ndjson request body
+
+    Passwords are hashed while the request waits, so at most
+    BULK_IMPORT_MAX_ROWS rows are read; ``next_line`` tells where to resume
+    (larger files go through ``flask import-users``).
+    """
+    fmt = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+    max_rejects = app.config['BULK_IMPORT_MAX_REJECTS']
+    rejects = []
+
+    def reject(line_number, row, error):
+        if len(rejects) < max_rejects:
+            rejects.append({'line': line_number, 'row': without_password(row), 'error': error})
+
+    lines = (line.decode('utf-8') for line in request.stream)
+    stats = import_users(
+        lines,
+        fmt=fmt,
+        batch_size=app.config['BULK_IMPORT_BATCH_SIZE'],
+        workers=app.config['BULK_IMPORT_WORKERS'],
+        reject=reject,
+        max_rows=app.config['BULK_IMPORT_MAX_ROWS'] or None,
+    )
+    response = {
+        'status': 'ok',
+        'code': 200,
+        'data': {
+            'imported': stats['imported'],
+            'rejected': stats['rejected'],
+            'rejects': rejects,
+            'next_line': stats['next_line'],
+        }
+    }
+    return make_response(jsonify(response), 200)
+
+
+EXPORT_FIELDS = ['id', 'uuid', 'username', 'email', 'name', 'role_id']
+
+
+def export_users(fmt='ndjson', after_id=0, batch_size=1000):
+    """Yield the users after ``after_id`` as NDJSON or CSV text chunks"""
+    columns = [getattr(User, field) for field in EXPORT_FIELDS]
+    query = db.session.query(*columns) \
+                      .filter(User.id > after_id) \
+                      .order_by(User.id) \
+                      .yield_per(batch_size)
+
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        for row in query:
+            writer.writerow(row)
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+        return
+
+    for row in query:
+        yield json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n'
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.route('/api/v1/users/export', methods=['GET'])
+@admin_required()
+def users_export():
+    """Stream all users as ?format=ndjson|csv, ?after=<id> resumes, ?gzip=1 compresses"""
+    fmt = request.args.get('format', 'ndjson')
+    try:
+        after_id = int(request.args.get('after', 0))
+        if fmt not in ('csv', 'ndjson'):
+            raise ValueError
+    except ValueError:
+        response = {
+            'status': 'fail',
+            'code': 422,
+            'data': {
+                'error': 'format must be csv/ndjson and after an integer'
+            }
+        }
+        return make_response(jsonify(response), 422)
+
+    chunks = export_users(fmt, after_id, app.config['USERS_STREAM_BATCH'])
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    filename = 'users.{}'.format(fmt)
+    if request.args.get('gzip') in ('1', 'true'):
+        chunks = gzipped(chunks)
+        mimetype = 'application/gzip'
+        filename += '.gz'
+
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename={}'.format(filename)
+    return response
@@ -0,0 +1,32 @@
+from flask.helpers import make_response
+from flask import jsonify
+from main import app, db
+from database import pool_status
+from .utils import admin_required, revocation_log, shared_revocations, token_cache
+
+
+@app.route('/api/v1/diagnostics/token-cache', methods=['GET'])
+@admin_required()
+def token_cache_stats():
+    data = token_cache.stats()
+    if shared_revocations is not None:
+        data['shared_revocations'] = shared_revocations.stats()
+    if revocation_log is not None:
+        data['revocation_log'] = revocation_log.stats()
+    response = {
+        'status': 'ok',
+        'code': 200,
+        'data': data
+    }
+    return make_response(jsonify(response), 200)
+
+
+@app.route('/api/v1/diagnostics/pool', methods=['GET'])
+@admin_required()
+def pool_stats():
+    response = {
+        'status': 'ok',
+        'code': 200,
+        'data': pool_status(db.engine)
+    }
+    return make_response(jsonify(response), 200)
@@ -0,0 +1,148 @@
+"""Password hashing off the request thread
+
+Hashing and verifying passwords is CPU bound. When PASSWORD_HASH_WORKERS is
+set the work runs in a process pool shared by the threads of a worker, with
+at most PASSWORD_HASH_QUEUE_SIZE calls waiting for it; anything beyond that,
+or a call that does not finish within PASSWORD_HASH_TIMEOUT seconds, fails
+fast with a 503 instead of tying up the thread that serves /me or /refresh.
+"""
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from threading import BoundedSemaphore, Lock
+import os
+import time
+
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+
+from main import app
+from metrics import PASSWORD_HASH_DURATION, timed
+
+
+class HashingUnavailable(ServiceUnavailable):
+    description = 'password hashing is busy, retry later'
+
+
+class HashingService(object):
+    """Runs werkzeug's hash functions inline (``workers=0``) or in a pool"""
+
+    def __init__(self, workers=0, queue_size=0, timeout=None, method='pbkdf2:sha256'):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = BoundedSemaphore(workers + queue_size) if workers else None
+        self._pool = None
+        self._pool_pid = None
+        self._lock = Lock()
+
+    def _executor(self):
+        # a pool inherited through gunicorn's fork is unusable, build one per process
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+
+        if not self._slots.acquire(blocking=False):
+            raise HashingUnavailable()
+        try:
+            future = self._executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # the slot is held until the hash really finishes, even after a timeout
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HashingUnavailable()
+
+    def hash(self, password, method=None):
+        with timed('hash', PASSWORD_HASH_DURATION.labels('hash')):
+            return self._run(generate_password_hash, password, method or self.method)
+
+    def verify(self, pwhash, password):
+        with timed('hash', PASSWORD_HASH_DURATION.labels('verify')):
+            return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True when ``pwhash`` was made with other parameters than ``method``"""
+        return pwhash.split('$', 1)[0] != stored_method(self.method)
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown(wait=False)
+            self._pool = None
+
+
+def stored_method(method):
+    """``method`` as werkzeug writes it in front of the hash
+
+    pbkdf2 without an iteration count (or hash name) uses werkzeug's
+    defaults, which the stored hash spells out: ``pbkdf2:sha256:<n>``.
+    """
+    parts = method.split(':')
+    if parts[0] != 'pbkdf2':
+        return method
+    hash_name = parts[1] if len(parts) > 1 else 'sha256'
+    iterations = parts[2] if len(parts) > 2 else DEFAULT_PBKDF2_ITERATIONS
+    return 'pbkdf2:{}:{}'.format(hash_name, iterations)
+
+
+def password_method(config):
+    """werkzeug method string, e.g. ``pbkdf2:sha256:260000``"""
+    method = config.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+    iterations = config.get('PASSWORD_HASH_ITERATIONS')
+    if iterations and method.startswith('pbkdf2:'):
+        method = '{}:{}'.format(method, iterations)
+    return method
+
+
+def calibrate(target_ms, method='pbkdf2:sha256', sample_iterations=50000, rounds=3):
+    """Measure pbkdf2 on this machine and suggest iterations for ``target_ms``"""
+    sample = '{}:{}'.format(method, sample_iterations)
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        generate_password_hash('calibration-password', sample)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    per_iteration_ms = best * 1000 / sample_iterations
+    return {
+        'method': method,
+        'ms_per_1000_iterations': round(per_iteration_ms * 1000, 3),
+        'suggested_iterations': int(target_ms / per_iteration_ms),
+    }
+
+
+def hash_many(passwords, method, pool=None, chunksize=16):
+    """Hash a batch of passwords, spread over ``pool`` when given"""
+    if pool is None:
+        return [generate_password_hash(password, method) for password in passwords]
+    return list(pool.map(generate_password_hash, passwords,
+                         [method] * len(passwords), chunksize=chunksize))
+
+
+hashing_service = HashingService(
+    method=password_method(app.config),
+    workers=app.config.get('PASSWORD_HASH_WORKERS', 0),
+    queue_size=app.config.get('PASSWORD_HASH_QUEUE_SIZE', 0),
+    timeout=app.config.get('PASSWORD_HASH_TIMEOUT'),
+)
+
+
+def hash_password(password):
+    return hashing_service.hash(password)
+
+
+def verify_password(pwhash, password):
+    return hashing_service.verify(pwhash, password)
+
+
+def needs_rehash(pwhash):
+    return hashing_service.needs_rehash(pwhash)
@@ -0,0 +1,30 @@
+"""Request scoped identity context
+
+The authenticated user is loaded lazily, with its role joined, the first
+time a view asks for it and reused for the rest of the request. Endpoints
+that only need the token claims (logout, admin checks with a current
+role claim) never load it at all.
+"""
+from flask import _request_ctx_stack
+from flask_jwt_extended import get_jwt_identity
+
+from database import primary_reads, reading_replicas
+from .queries import user_by_uuid
+
+
+def current_user():
+    """User owning the verified JWT of this request, or None if it is gone"""
+    # kept on the request context (like flask-jwt-extended does with the
+    # decoded token) rather than on g, which may outlive a single request
+    ctx = _request_ctx_stack.top
+    if not hasattr(ctx, 'identity_user'):
+        user_identity = get_jwt_identity()
+        user = None
+        if user_identity is not None:
+            user = user_by_uuid(user_identity)
+            if user is None and reading_replicas():
+                # a replica may not have a new user yet
+                with primary_reads():
+                    user = user_by_uuid(user_identity)
+        ctx.identity_user = user
+    return ctx.identity_user
@@ -0,0 +1,57 @@
+from flask.helpers import make_response
+from flask import request, jsonify
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
+from marshmallow import ValidationError
+from main import app
+from schemas.token import TokenIntrospectSchema
+from .utils import admin_required, revoked_jtis
+
+
+@app.route('/api/v1/tokens/introspect', methods=['POST'])
+@admin_required()
+def introspect():
+    """Verify a batch of tokens for API gateways
+
+    Signatures and expiry are checked locally, revocation for the whole
+    batch is resolved with a single query.
+    """
+    try:
+        tokens = TokenIntrospectSchema().load(request.json or {})['tokens']
+    except ValidationError as err:
+        response = {
+            'status': 'fail',
+            'code': 422,
+            'data': {
+                'error': err.messages
+            }
+        }
+        return make_response(jsonify(response), 422)
+
+    decoded = []
+    for encoded_token in tokens:
+        try:
+            decoded.append(decode_token(encoded_token))
+        except (PyJWTError, JWTExtendedException):
+            decoded.append(None)
+
+    revoked = revoked_jtis([payload for payload in decoded if payload])
+    results = []
+    for payload in decoded:
+        if payload is None or revoked[payload['jti']]:
+            results.append({'active': False})
+        else:
+            results.append({
+                'active': True,
+                'sub': payload[app.config['JWT_IDENTITY_CLAIM']],
+                'exp': payload['exp'],
+                'type': payload['type'],
+            })
+
+    response = {
+        'status': 'ok',
+        'code': 200,
+        'data': results
+    }
+    return make_response(jsonify(response), 200)
@@ -0,0 +1,154 @@
+"""Asymmetric token signing and the JWKS endpoint
+
+With an RS*/ES*/EdDSA ``JWT_ALGORITHM`` every ``<kid>.pem`` private key in
+JWT_KEYS_DIR is loaded and checked when a worker boots (one without usable
+keys fails to boot), not when the app is imported, so CLI commands such as
+generate-signing-key work before there are any keys. The JWT_ACTIVE_KID key signs new tokens and tags them
+with its ``kid`` header; all of them stay valid for verification and are
+published at /.well-known/jwks.json, so downstream services verify tokens
+locally. To rotate, add the new key, deploy, switch JWT_ACTIVE_KID once
+consumers have refreshed their JWKS, and remove the old key after the
+longest token lifetime has passed.
+"""
+import json
+import os
+
+import jwt as pyjwt
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+from flask import jsonify, request
+from jwt import InvalidTokenError
+from jwt.algorithms import ECAlgorithm, OKPAlgorithm, RSAAlgorithm
+
+from main import app, jwt
+
+
+class KeyRing(object):
+
+    def __init__(self, keys_dir=None, algorithm='RS256', active_kid=None):
+        self.algorithm = algorithm
+        self.keys = {}
+        if keys_dir:
+            self.load(keys_dir)
+        self.active_kid = active_kid or (sorted(self.keys)[-1] if self.keys else None)
+        if self.active_kid is not None and self.active_kid not in self.keys:
+            raise ValueError('no key for JWT_ACTIVE_KID {}'.format(self.active_kid))
+
+    def load(self, keys_dir):
+        if not os.path.isdir(keys_dir):
+            raise ValueError('JWT_KEYS_DIR {} is not a directory'.format(keys_dir))
+        for filename in sorted(os.listdir(keys_dir)):
+            if not filename.endswith('.pem'):
+                continue
+            with open(os.path.join(keys_dir, filename), 'rb') as f:
+                key = serialization.load_pem_private_key(f.read(), password=None)
+            self.keys[filename[:-len('.pem')]] = key
+
+    def validate(self):
+        """Fail at startup, not on the first login, if the keys cannot sign
+        and verify ``algorithm`` tokens
+        """
+        if not self.keys:
+            raise ValueError('no <kid>.pem keys for JWT_ALGORITHM {}, check JWT_KEYS_DIR'
+                             .format(self.algorithm))
+        for kid in self.keys:
+            try:
+                token = pyjwt.encode({'sub': 'startup'}, self.keys[kid], self.algorithm)
+                pyjwt.decode(token, self.verifying_key(kid), algorithms=[self.algorithm])
+            except (InvalidTokenError, TypeError, ValueError, NotImplementedError) as err:
+                raise ValueError('key {} cannot be used with {}: {}'.format(kid, self.algorithm, err))
+
+    def signing_key(self):
+        return self.keys[self.active_kid]
+
+    def verifying_key(self, kid):
+        key = self.keys.get(kid)
+        if key is None:
+            raise InvalidTokenError('unknown signing key')
+        return key.public_key()
+
+    def jwks(self):
+        keys = []
+        for kid, key in sorted(self.keys.items()):
+            public_key = key.public_key()
+            if isinstance(public_key, rsa.RSAPublicKey):
+                jwk = json.loads(RSAAlgorithm.to_jwk(public_key))
+            elif isinstance(public_key, ec.EllipticCurvePublicKey):
+                jwk = json.loads(ECAlgorithm.to_jwk(public_key))
+            else:
+                jwk = json.loads(OKPAlgorithm.to_jwk(public_key))
+            jwk.update({'kid': kid, 'alg': self.algorithm, 'use': 'sig'})
+            keys.append(jwk)
+        return {'keys': keys}
+
+
+def generate_key(algorithm):
+    """New private key suitable for ``algorithm``"""
+    if algorithm.startswith(('RS', 'PS')):
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    if algorithm == 'ES256':
+        return ec.generate_private_key(ec.SECP256R1())
+    if algorithm == 'ES384':
+        return ec.generate_private_key(ec.SECP384R1())
+    if algorithm == 'EdDSA':
+        return ed25519.Ed25519PrivateKey.generate()
+    raise ValueError('unsupported algorithm {}'.format(algorithm))
+
+
+def write_key(path, key):
+    pem = key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    with open(path, 'wb') as f:
+        f.write(pem)
+    os.chmod(path, 0o600)
+
+
+def asymmetric(algorithm):
+    return not algorithm.startswith('HS')
+
+
+keyring = KeyRing()
+
+
+def load_keyring():
+    """Load and check the signing keys, once per process
+
+    wsgi.py calls it as a worker boots: a worker that cannot sign does not
+    boot, so the pod never gets ready. ``flask run`` loads them before the
+    first request.
+    """
+    global keyring
+    if asymmetric(app.config['JWT_ALGORITHM']) and not keyring.keys:
+        loaded = KeyRing(app.config.get('JWT_KEYS_DIR'),
+                         algorithm=app.config['JWT_ALGORITHM'],
+                         active_kid=app.config.get('JWT_ACTIVE_KID'))
+        loaded.validate()
+        keyring = loaded
+
+
+if asymmetric(app.config['JWT_ALGORITHM']):
+    app.before_first_request(load_keyring)
+
+    @jwt.encode_key_loader
+    def signing_key_callback(identity):
+        return keyring.signing_key()
+
+    @jwt.additional_headers_loader
+    def kid_header_callback(identity):
+        return {'kid': keyring.active_kid}
+
+    @jwt.decode_key_loader
+    def verifying_key_callback(jwt_headers, jwt_payload):
+        return keyring.verifying_key(jwt_headers.get('kid'))
+
+
+@app.route('/.well-known/jwks.json', methods=['GET'])
+def jwks():
+    response = jsonify(keyring.jwks())
+    response.headers['Cache-Control'] = 'public, max-age={}'.format(app.config['JWKS_MAX_AGE'])
+    response.add_etag()
+    return response.make_conditional(request)
@@ -0,0 +1,54 @@
+"""The queries that run on (almost) every request
+
+Built as lambda statements or prebuilt selects so SQLAlchemy reuses their
+compiled form instead of going through ``Model.query.filter_by`` each
+time, and selecting only the columns the caller needs: the jti lookups
+no longer pull in the ``users`` join of ``Token.user``.
+"""
+from sqlalchemy import bindparam, lambda_stmt, select
+from sqlalchemy.orm import joinedload
+
+from main import db
+from models.tokens import Token
+from models.users import User
+
+_user_by_uuid = select(User).options(joinedload(User.roles)) \
+                            .where(User.uuid == bindparam('uuid'))
+_user_by_username = select(User).options(joinedload(User.roles)) \
+                                .where(User.username == bindparam('username'))
+
+
+def token_revoked(jti):
+    """revoked flag of an issued token, None if the jti was never stored"""
+    return db.session.execute(
+        lambda_stmt(lambda: select(Token.revoked).where(Token.jti == jti))
+    ).scalar()
+
+
+def user_by_uuid(uuid):
+    """User with its role joined, or None"""
+    return db.session.execute(_user_by_uuid, {'uuid': uuid}).scalars().first()
+
+
+def user_by_username(username):
+    """User with its role joined, or None"""
+    return db.session.execute(_user_by_username, {'username': username}).scalars().first()
+
+
+def role_version(uuid):
+    return db.session.execute(
+        lambda_stmt(lambda: select(User.role_version).where(User.uuid == uuid))
+    ).scalar()
+
+
+def tokens_valid_after(uuid):
+    return db.session.execute(
+        lambda_stmt(lambda: select(User.tokens_valid_after).where(User.uuid == uuid))
+    ).scalar()
+
+
+def tokens_valid_after_many(uuids):
+    """uuid -> tokens_valid_after of the users that exist, in one query"""
+    return dict(db.session.execute(
+        select(User.uuid, User.tokens_valid_after).where(User.uuid.in_(uuids))
+    ).all())
@@ -0,0 +1,346 @@
+"""Where issued and revoked jtis are stored
+
+``REVOCATION_BACKEND`` picks one of:
+
+``sql``
+    the ``tokens`` table (the default), with every revocation also
+    appended to ``revocation_events`` while revocation sync is on. In allowlist mode it is read through
+    the replicas; in denylist mode, where a replica that has not caught up
+    would report a revoked token as valid, from the primary.
+``memory``
+    a dict in the worker process, for tests and single process installs
+    only: every worker and pod has its own, so a logout is not seen by the
+    others and (in allowlist mode) a token issued by one is rejected by the
+    rest. Gunicorn refuses to start it with more than one worker.
+``sqlite``
+    a SQLite file in WAL mode (REVOCATION_SQLITE_PATH) shared by the
+    workers of one node, for single-node installs without MySQL.
+
+In denylist mode (TOKEN_STORAGE_MODE) ``add`` stores nothing and only
+revoked jtis are kept. The caches in front of the backend (token cache,
+shared memory set, revocation log, write-behind) live in ``utils``; the
+revocation log only follows the ``sql`` backend.
+"""
+from datetime import datetime
+from threading import Lock, local
+import os
+import sqlite3
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from main import app, db
+from database import mark_written, may_read_replica, replica_keys, run_read_only
+from models.revocation_events import RevocationEvent
+from models.tokens import Token
+from . import queries
+from .revocation_log import sync_enabled, unexpired_revocations
+
+
+class RevocationBackend(object):
+    """Interface of the token stores
+
+    ``records`` are the dicts built by ``issue_token`` (jti, token_type,
+    user_uuid, expires as a naive local datetime, revoked).
+    """
+
+    def __init__(self, denylist=None):
+        # callable, True when only revoked jtis are stored
+        self.denylist = denylist or (lambda: False)
+
+    def add(self, records):
+        """Store issued tokens as not revoked"""
+        raise NotImplementedError
+
+    def is_revoked(self, jti, user=None):
+        """True/False for a stored jti, None if the backend has no record of it"""
+        raise NotImplementedError
+
+    def may_be_stale(self, user=None):
+        """True if ``is_revoked`` may answer from a copy lagging behind
+        revocations made elsewhere, such not-revoked answers are not cached
+        """
+        return False
+
+    def is_revoked_many(self, jtis):
+        """jti -> revoked for the stored ones among ``jtis``"""
+        result = {}
+        for jti in jtis:
+            revoked = self.is_revoked(jti)
+            if revoked is not None:
+                result[jti] = revoked
+        return result
+
+    def revoke(self, jti, user, token_type=None, expires=None):
+        """Mark ``jti`` revoked, storing it if it is unknown (which needs
+        ``expires``). Returns its expiry, None if it is not known.
+        """
+        raise NotImplementedError
+
+    def revoke_many(self, records):
+        for record in records:
+            self.revoke(record['jti'], record['user_uuid'],
+                        token_type=record.get('token_type'), expires=record.get('expires'))
+
+    def purge_expired(self, chunk_size=1000, pause=0.1, dry_run=False):
+        """Delete expired tokens, returns how many (would) have been deleted"""
+        raise NotImplementedError
+
+    def revocations(self):
+        """(jti, exp) of the revoked tokens that have not expired yet"""
+        raise NotImplementedError
+
+
+def purge_expired_rows(model, chunk_size=1000, pause=0.1, dry_run=False):
+    """Delete expired rows of ``model`` in bounded chunks
+
+    Each chunk is selected through the ``expires`` index and deleted by
+    primary key in its own short transaction, sleeping ``pause`` seconds
+    between chunks so the purge never holds long locks. Returns the number
+    of rows deleted (or that would be deleted with ``dry_run``).
+    """
+    now = datetime.now()
+    if dry_run:
+        return model.query.filter(model.expires < now).count()
+
+    deleted = 0
+    while True:
+        ids = [row.id for row in db.session.query(model.id)
+                                          .filter(model.expires < now)
+                                          .order_by(model.expires)
+                                          .limit(chunk_size)]
+        if not ids:
+            break
+        model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(ids)
+        if len(ids) < chunk_size:
+            break
+        time.sleep(pause)
+    return deleted
+
+
+class SQLRevocationBackend(RevocationBackend):
+
+    def __init__(self, denylist=None, writer=None):
+        super(SQLRevocationBackend, self).__init__(denylist)
+        # optional write-behind queue for ``add``
+        self.writer = writer
+
+    def add(self, records):
+        """Insert the rows and commit, with whatever else the session holds"""
+        if self.denylist() or not records:
+            return
+        if self.writer is not None:
+            self.writer.submit(records)
+            return
+        db.session.execute(Token.__table__.insert(), records)
+        db.session.commit()
+        for user_uuid in set(record['user_uuid'] for record in records):
+            mark_written(app, user_uuid)
+
+    def is_revoked(self, jti, user=None):
+        if self.denylist():
+            # a missing row means valid, a lagging replica must not answer
+            return queries.token_revoked(jti)
+        revoked = run_read_only(db, queries.token_revoked, jti, sticky_key=user)
+        if revoked is None and replica_keys(app):
+            # a replica may not have the rows of a login yet
+            revoked = queries.token_revoked(jti)
+        return revoked
+
+    def may_be_stale(self, user=None):
+        return not self.denylist() and may_read_replica(app, user)
+
+    def is_revoked_many(self, jtis):
+        return dict(db.session.query(Token.jti, Token.revoked).filter(Token.jti.in_(list(jtis))))
+
+    def _revoke(self, jti, user, token_type, expires):
+        updated = Token.query.filter_by(jti=jti, user_uuid=user) \
+                             .update({Token.revoked: True}, synchronize_session=False)
+        if updated and expires is None:
+            expires = db.session.query(Token.expires).filter_by(jti=jti).scalar()
+        elif not updated:
+            if expires is None:
+                raise Exception("Could not find the token {}".format(jti))
+            db.session.add(Token(jti=jti, token_type=token_type, user_uuid=user,
+                                 expires=expires, revoked=True))
+        if sync_enabled():
+            db.session.add(RevocationEvent(jti=jti, user_uuid=user, expires=expires))
+        return expires
+
+    def revoke(self, jti, user, token_type=None, expires=None):
+        return self.revoke_many([{'jti': jti, 'user_uuid': user,
+                                  'token_type': token_type, 'expires': expires}])[jti]
+
+    def revoke_many(self, records):
+        """Revoke all of them in one transaction, returns jti -> expires"""
+        for attempt in range(2):
+            try:
+                result = {record['jti']: self._revoke(record['jti'], record['user_uuid'],
+                                                      record.get('token_type'), record.get('expires'))
+                          for record in records}
+                db.session.commit()
+                break
+            except IntegrityError:
+                # inserted meanwhile by another revoke or a write-behind
+                # flush, the update finds it the second time
+                db.session.rollback()
+                if attempt:
+                    raise
+        for user_uuid in set(record['user_uuid'] for record in records):
+            mark_written(app, user_uuid)
+        return result
+
+    def purge_expired(self, chunk_size=1000, pause=0.1, dry_run=False):
+        return purge_expired_rows(Token, chunk_size=chunk_size, pause=pause, dry_run=dry_run)
+
+    def revocations(self):
+        return unexpired_revocations()
+
+
+class MemoryRevocationBackend(RevocationBackend):
+
+    def __init__(self, denylist=None):
+        super(MemoryRevocationBackend, self).__init__(denylist)
+        self._tokens = {}  # jti -> (revoked, exp)
+        self._lock = Lock()
+
+    def add(self, records):
+        if self.denylist():
+            return
+        with self._lock:
+            for record in records:
+                self._tokens.setdefault(record['jti'], (False, record['expires'].timestamp()))
+
+    def is_revoked(self, jti, user=None):
+        entry = self._tokens.get(jti)
+        return None if entry is None else entry[0]
+
+    def revoke(self, jti, user, token_type=None, expires=None):
+        with self._lock:
+            entry = self._tokens.get(jti)
+            if entry is None and expires is None:
+                raise Exception("Could not find the token {}".format(jti))
+            exp = entry[1] if entry is not None else expires.timestamp()
+            self._tokens[jti] = (True, exp)
+        return datetime.fromtimestamp(exp)
+
+    def purge_expired(self, chunk_size=1000, pause=0.1, dry_run=False):
+        now = time.time()
+        with self._lock:
+            expired = [jti for jti, (revoked, exp) in self._tokens.items() if exp < now]
+            if not dry_run:
+                for jti in expired:
+                    del self._tokens[jti]
+        return len(expired)
+
+    def revocations(self):
+        now = time.time()
+        return [(jti, exp) for jti, (revoked, exp) in list(self._tokens.items())
+                if revoked and exp > now]
+
+
+class SQLiteRevocationBackend(RevocationBackend):
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS tokens ('
+        ' jti TEXT PRIMARY KEY, revoked INTEGER NOT NULL, expires REAL NOT NULL'
+        ') WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS tokens_expires ON tokens (expires)',
+    )
+
+    def __init__(self, path, denylist=None, timeout=5):
+        super(SQLiteRevocationBackend, self).__init__(denylist)
+        self.path = path
+        self.timeout = timeout
+        self._local = local()
+
+    def _connection(self):
+        # one connection per thread, and a fresh one after a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            with connection:
+                for statement in self.SCHEMA:
+                    connection.execute(statement)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def add(self, records):
+        if self.denylist():
+            return
+        with self._connection() as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO tokens (jti, revoked, expires) VALUES (?, 0, ?)',
+                [(record['jti'], record['expires'].timestamp()) for record in records])
+
+    def is_revoked(self, jti, user=None):
+        row = self._connection().execute('SELECT revoked FROM tokens WHERE jti = ?', (jti,)).fetchone()
+        return None if row is None else bool(row[0])
+
+    def is_revoked_many(self, jtis):
+        jtis = list(jtis)
+        if not jtis:
+            return {}
+        rows = self._connection().execute(
+            'SELECT jti, revoked FROM tokens WHERE jti IN ({})'.format(','.join('?' * len(jtis))), jtis)
+        return {jti: bool(revoked) for jti, revoked in rows}
+
+    def _revoke(self, connection, jti, expires):
+        row = connection.execute('SELECT expires FROM tokens WHERE jti = ?', (jti,)).fetchone()
+        if row is None:
+            if expires is None:
+                raise Exception("Could not find the token {}".format(jti))
+            connection.execute('INSERT INTO tokens (jti, revoked, expires) VALUES (?, 1, ?)',
+                               (jti, expires.timestamp()))
+            return expires
+        connection.execute('UPDATE tokens SET revoked = 1 WHERE jti = ?', (jti,))
+        return datetime.fromtimestamp(row[0])
+
+    def revoke(self, jti, user, token_type=None, expires=None):
+        with self._connection() as connection:
+            return self._revoke(connection, jti, expires)
+
+    def revoke_many(self, records):
+        with self._connection() as connection:
+            return {record['jti']: self._revoke(connection, record['jti'], record.get('expires'))
+                    for record in records}
+
+    def purge_expired(self, chunk_size=1000, pause=0.1, dry_run=False):
+        now = time.time()
+        connection = self._connection()
+        if dry_run:
+            return connection.execute('SELECT COUNT(*) FROM tokens WHERE expires < ?', (now,)).fetchone()[0]
+        deleted = 0
+        while True:
+            with connection:
+                count = connection.execute(
+                    'DELETE FROM tokens WHERE jti IN '
+                    '(SELECT jti FROM tokens WHERE expires < ? ORDER BY expires LIMIT ?)',
+                    (now, chunk_size)).rowcount
+            deleted += count
+            if count < chunk_size:
+                break
+            time.sleep(pause)
+        return deleted
+
+    def revocations(self):
+        return self._connection().execute(
+            'SELECT jti, expires FROM tokens WHERE revoked = 1 AND expires > ?', (time.time(),)).fetchall()
+
+
+def create_backend(config, denylist=None, writer=None):
+    name = config.get('REVOCATION_BACKEND', 'sql')
+    if name == 'sql':
+        return SQLRevocationBackend(denylist=denylist, writer=writer)
+    if name == 'memory':
+        app.logger.warning('REVOCATION_BACKEND=memory is per process: run a single worker, '
+                           'revocations are not shared with other workers or pods')
+        return MemoryRevocationBackend(denylist=denylist)
+    if name == 'sqlite':
+        return SQLiteRevocationBackend(config['REVOCATION_SQLITE_PATH'], denylist=denylist)
+    raise ValueError('unknown REVOCATION_BACKEND {}, expected sql, memory or sqlite'.format(name))
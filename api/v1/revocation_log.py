@@ -0,0 +1,167 @@
+"""Revocations made by other workers and replicas, synced from the database
+
+With REVOCATION_SYNC_INTERVAL set, ``revoke_token`` appends to
+``revocation_events`` in the transaction that revokes the token (without
+it nothing would read them, so none are written) and every worker warms a
+local set of jti -> exp from the revoked, unexpired tokens, then a daemon
+thread pulls the events after the last id it has seen every interval
+seconds, so a logout handled anywhere is seen everywhere within about one
+interval without a query per request.
+
+Ids are allocated before commit, so a transaction can commit an id lower
+than one already seen; every poll re-reads the last
+REVOCATION_SYNC_LOOKBACK ids to pick those up. If polling fails for three
+intervals in a row the set is no longer ``fresh`` and callers fall back to
+the database.
+"""
+from datetime import datetime
+from threading import Event, Lock, Thread
+import os
+import time
+
+from sqlalchemy import func
+
+from main import app, db
+from models.revocation_events import RevocationEvent
+from models.tokens import Token
+
+
+def sync_enabled():
+    return bool(app.config.get('REVOCATION_SYNC_INTERVAL'))
+
+
+def unexpired_revocations():
+    """(jti, exp) of every revoked token that has not expired yet"""
+    now = datetime.now()
+    for jti, expires in db.session.query(Token.jti, Token.expires) \
+                                  .filter(Token.revoked == True, Token.expires > now) \
+                                  .yield_per(1000):
+        yield jti, expires.timestamp()
+
+
+class RevocationLog(object):
+
+    def __init__(self, interval, lookback=100, batch_size=1000, on_revoke_all=None):
+        self.interval = interval
+        self.lookback = lookback
+        self.batch_size = batch_size
+        # called with the user uuid of a revoke-all event
+        self.on_revoke_all = on_revoke_all
+        self.last_id = 0
+        self.last_sync = None
+        self.warmed = False
+        self._revoked = {}
+        self._applied = set()
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+        self._pid = None
+
+    def add(self, jti, exp):
+        with self._lock:
+            self._revoked[jti] = max(exp, self._revoked.get(jti, 0))
+
+    def contains(self, jti, now=None):
+        exp = self._revoked.get(jti)
+        return exp is not None and exp > (time.time() if now is None else now)
+
+    def fresh(self):
+        """True while the set reflects the database up to ~one interval ago"""
+        return self.warmed and self.last_sync is not None and \
+            time.time() - self.last_sync < 3 * self.interval
+
+    def warm(self):
+        # the max id is read first: whatever commits meanwhile is either in
+        # the token scan or in the first poll
+        last_id = db.session.query(func.max(RevocationEvent.id)).scalar() or 0
+        # committed events of the lookback window are already reflected
+        applied = set(id for id, in db.session.query(RevocationEvent.id)
+                                              .filter(RevocationEvent.id > last_id - self.lookback))
+        revoked = dict(unexpired_revocations())
+        with self._lock:
+            self._revoked = revoked
+            self._applied = applied
+            self.last_id = last_id
+        self.warmed = True
+        self.last_sync = time.time()
+
+    def apply(self, events):
+        for event in events:
+            if event.id in self._applied:
+                continue
+            if event.jti is None:
+                if self.on_revoke_all is not None:
+                    self.on_revoke_all(event.user_uuid)
+            else:
+                self.add(event.jti, event.expires.timestamp())
+            self._applied.add(event.id)
+            self.last_id = max(self.last_id, event.id)
+
+    def poll(self):
+        """Apply the events after the last seen id, returns how many were new"""
+        applied = len(self._applied)
+        after = max(self.last_id - self.lookback, 0)
+        while True:
+            events = db.session.query(RevocationEvent.id, RevocationEvent.jti,
+                                      RevocationEvent.user_uuid, RevocationEvent.expires) \
+                               .filter(RevocationEvent.id > after) \
+                               .order_by(RevocationEvent.id) \
+                               .limit(self.batch_size).all()
+            self.apply(events)
+            if len(events) < self.batch_size:
+                break
+            after = events[-1].id
+        new = len(self._applied) - applied
+        self._prune()
+        self.last_sync = time.time()
+        return new
+
+    def _prune(self):
+        now = time.time()
+        with self._lock:
+            self._revoked = {jti: exp for jti, exp in self._revoked.items() if exp > now}
+        self._applied = {id for id in self._applied if id > self.last_id - self.lookback}
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with app.app_context():
+                try:
+                    # without the warm-up a miss would not mean anything
+                    if self.warmed:
+                        self.poll()
+                    else:
+                        self.warm()
+                except Exception as err:
+                    app.logger.warning('revocation sync failed: %s', err)
+                finally:
+                    db.session.remove()
+
+    def start(self):
+        """Warm up and start polling, once per process"""
+        # threads do not survive gunicorn's fork, every worker runs its own
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.warmed = False
+        self.last_sync = None
+        self._stop.clear()
+        try:
+            self.warm()
+        except Exception as err:
+            app.logger.warning('could not warm the revocation log: %s', err)
+        self._thread = Thread(target=self._run, name='revocation-sync', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._pid = None
+
+    def stats(self):
+        return {
+            'revoked': len(self._revoked),
+            'last_id': self.last_id,
+            'fresh': self.fresh(),
+            'seconds_since_sync': round(time.time() - self.last_sync, 3) if self.last_sync else None,
+        }
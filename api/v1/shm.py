@@ -0,0 +1,243 @@
+"""Revoked jtis shared by all workers of a node
+
+A fixed-size open-addressing hash table of jti -> exp in a memory-mapped
+file (REVOCATION_SHM_PATH, REVOCATION_SHM_SLOTS slots). Writers serialize
+on an flock of the file; readers probe the table without any lock, which
+is safe because a slot never goes back to empty: its key is written
+before its exp, and a slot is only reused once its exp has passed. A read
+racing a write can at worst miss the revocation being written, exactly as
+if it had happened a moment later. When three quarters of the slots are
+taken, the writer drops the expired entries and rebuilds the table in
+place; it bumps a generation counter around the rebuild (a seqlock) and
+readers that overlap it retry. The header keeps the earliest exp in the
+table, so it is only rebuilt once that has passed: with no entry expired
+yet a full table rejects new ones straight away instead of rebuilding on
+every insert.
+
+The header records whether the table holds every revocation: set once a
+worker has warmed it from the database, cleared if an insert ever finds
+no free slot.
+
+Every slot is 16 bytes of key (the jti's uuid bytes, or a digest of it)
+followed by the exp as a little-endian int64; an exp of 0 marks an empty
+slot and ends a probe sequence.
+"""
+from contextlib import contextmanager
+from threading import Lock
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import time
+import uuid
+
+MAGIC = b'SCREVOK2'
+HEADER = struct.Struct('<8sQQQQq')  # magic, slots, complete, used, generation, min exp
+SLOT = struct.Struct('<16sq')
+MAX_LOAD = 0.75
+
+
+def jti_key(jti):
+    try:
+        return uuid.UUID(jti).bytes
+    except ValueError:
+        return hashlib.blake2b(jti.encode(), digest_size=16).digest()
+
+
+class SharedRevocationSet(object):
+
+    def __init__(self, path, slots=262144):
+        self.path = path
+        self.slots = slots
+        self.size = HEADER.size + slots * SLOT.size
+        self._file = None
+        self._map = None
+        self._pid = None
+        self._lock = Lock()
+
+    def _mapping(self):
+        # an flock is held by the open file description, which a forked
+        # worker would share with its siblings: open the file once per process
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._open()
+        return self._map
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        f = os.fdopen(fd, 'r+b')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.fstat(f.fileno()).st_size != self.size or f.read(len(MAGIC)) != MAGIC:
+                self._reset(f)
+            self._file = f
+            self._map = mmap.mmap(f.fileno(), self.size)
+            self._pid = os.getpid()
+            self._repair(self._map)
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _reset(self, f):
+        f.truncate(0)
+        f.truncate(self.size)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, self.slots, 0, 0, 0, 0))
+        f.flush()
+
+    def _repair(self, buf):
+        # with the flock held nobody is rebuilding, an odd generation means
+        # a worker died halfway through: start over, not complete
+        if self._generation(buf) % 2:
+            buf[:self.size] = bytes(self.size)
+            HEADER.pack_into(buf, 0, MAGIC, self.slots, 0, 0, 0, 0)
+
+    def _header(self):
+        return HEADER.unpack_from(self._mapping(), 0)
+
+    def _offset(self, index):
+        return HEADER.size + index * SLOT.size
+
+    def _probe(self, key):
+        start = int.from_bytes(key[:8], 'little') % self.slots
+        for i in range(self.slots):
+            yield (start + i) % self.slots
+
+    def _generation(self, buf):
+        return HEADER.unpack_from(buf, 0)[4]
+
+    def _lookup(self, buf, key, now):
+        for index in self._probe(key):
+            slot_key, exp = SLOT.unpack_from(buf, self._offset(index))
+            if exp == 0:
+                return False
+            if slot_key == key and exp > now:
+                return True
+        return False
+
+    def contains(self, jti, now=None):
+        """True if ``jti`` was revoked and has not expired yet, lock free"""
+        key = jti_key(jti)
+        now = time.time() if now is None else now
+        buf = self._mapping()
+        retries = 0
+        while True:
+            generation = self._generation(buf)
+            if generation % 2:
+                # a rebuild is in progress
+                retries += 1
+                if retries % 1000 == 0:
+                    with self._writing():
+                        self._repair(buf)
+                time.sleep(0)
+                continue
+            found = self._lookup(buf, key, now)
+            if self._generation(buf) == generation:
+                return found
+
+    @contextmanager
+    def _writing(self):
+        buf = self._mapping()
+        with self._lock:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                yield buf
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def _write_slot(self, buf, index, key, exp):
+        offset = self._offset(index)
+        buf[offset:offset + 16] = key
+        buf[offset + 16:offset + SLOT.size] = struct.pack('<q', exp)
+
+    def _find_slot(self, buf, key, exp, used, now):
+        """Slot to store ``key`` in and its exp, None when the table is full"""
+        free = None
+        for index in self._probe(key):
+            slot_key, slot_exp = SLOT.unpack_from(buf, self._offset(index))
+            if slot_key == key and slot_exp:
+                return index, max(exp, slot_exp)
+            if slot_exp == 0:
+                # keep a quarter of the slots empty so probes stay short
+                if free is None and used < self.slots * MAX_LOAD:
+                    free = index
+                break
+            if free is None and slot_exp <= now:
+                free = index
+        return None if free is None else (free, exp)
+
+    def _compact(self, buf, now):
+        """Rebuild the table without its expired entries"""
+        magic, slots, complete, used, generation, min_exp = HEADER.unpack_from(buf, 0)
+        HEADER.pack_into(buf, 0, magic, slots, complete, used, generation + 1, min_exp)
+        live = []
+        for index in range(self.slots):
+            slot_key, exp = SLOT.unpack_from(buf, self._offset(index))
+            if exp > now:
+                live.append((slot_key, exp))
+        buf[HEADER.size:self.size] = bytes(self.size - HEADER.size)
+        for key, exp in live:
+            index = next(index for index in self._probe(key)
+                         if SLOT.unpack_from(buf, self._offset(index))[1] == 0)
+            self._write_slot(buf, index, key, exp)
+        min_exp = min((exp for key, exp in live), default=0)
+        HEADER.pack_into(buf, 0, magic, slots, complete, len(live), generation + 2, min_exp)
+
+    def _insert(self, buf, entries, now):
+        rejected = 0
+        for jti, exp in entries:
+            exp = int(exp)
+            if exp <= now:
+                continue
+            key = jti_key(jti)
+            magic, slots, complete, used, generation, min_exp = HEADER.unpack_from(buf, 0)
+            found = self._find_slot(buf, key, exp, used, now)
+            if found is None and 0 < min_exp <= now:
+                # only worth a rebuild once some entry has expired
+                self._compact(buf, now)
+                magic, slots, complete, used, generation, min_exp = HEADER.unpack_from(buf, 0)
+                found = self._find_slot(buf, key, exp, used, now)
+            if found is None:
+                rejected += 1
+                complete = 0
+            else:
+                index, exp = found
+                if SLOT.unpack_from(buf, self._offset(index))[1] == 0:
+                    used += 1
+                self._write_slot(buf, index, key, exp)
+                min_exp = min(min_exp, exp) if min_exp else exp
+            HEADER.pack_into(buf, 0, magic, slots, complete, used, generation, min_exp)
+        return rejected
+
+    def add_many(self, entries, now=None):
+        """Store (jti, exp) pairs, returns how many did not fit"""
+        now = time.time() if now is None else now
+        with self._writing() as buf:
+            return self._insert(buf, entries, now)
+
+    def add(self, jti, exp):
+        return self.add_many([(jti, exp)]) == 0
+
+    def warm(self, load_entries):
+        """Fill the table from ``load_entries()`` unless it is already complete"""
+        with self._writing() as buf:
+            if HEADER.unpack_from(buf, 0)[2]:
+                return False
+            if self._insert(buf, load_entries(), time.time()):
+                return False
+            magic, slots, complete, used, generation, min_exp = HEADER.unpack_from(buf, 0)
+            HEADER.pack_into(buf, 0, magic, slots, 1, used, generation, min_exp)
+            return True
+
+    def complete(self):
+        return bool(self._header()[2])
+
+    def stats(self):
+        magic, slots, complete, used, generation, min_exp = self._header()
+        return {
+            'slots': slots,
+            'used': used,
+            'load_factor': round(used / slots, 4),
+            'complete': bool(complete),
+        }
@@ -3,52 +3,431 @@
 Heavily inspired by
 https://github.com/vimalloc/flask-jwt-extended/blob/master/examples/blocklist_database.py
 """
-from datetime import datetime
+from datetime import datetime, timezone
+import time
+import uuid
 from flask import jsonify, make_response
-from flask_jwt_extended import decode_token, get_jwt_identity,verify_jwt_in_request
+from flask_jwt_extended import (
+    create_access_token,
+    create_refresh_token,
+    get_jwt,
+    get_jwt_identity,
+    verify_jwt_in_request
+)
 
-from sqlalchemy.orm.exc import NoResultFound
-
-from main import db
+from main import app, db
+from database import mark_written, may_read_replica, replica_keys, run_read_only
+from metrics import TOKEN_CACHE_LOOKUPS
+from models.revocation_events import RevocationEvent
 from models.tokens import Token
 from models.users import User
 from functools import wraps
+from . import queries
+from .cache import TTLCache
+from .identity import current_user
+from .revocation import create_backend, purge_expired_rows
+from .revocation_log import RevocationLog, sync_enabled
+from .shm import SharedRevocationSet
+from .write_behind import TokenWriter
+
+# jti -> revoked, kept until the token's own exp
+token_cache = TTLCache(app.config.get('TOKEN_CACHE_SIZE', 0))
+# user uuid -> role_version, kept ROLE_VERSION_TTL seconds
+role_version_cache = TTLCache(app.config.get('ROLE_CACHE_SIZE', 0))
+# user uuid -> tokens_valid_after, kept TOKEN_WATERMARK_TTL seconds
+watermark_cache = TTLCache(app.config.get('TOKEN_WATERMARK_CACHE_SIZE', 0))
+# revoked jti -> exp, shared by the workers of this node
+shared_revocations = None
+if app.config.get('REVOCATION_SHM_PATH'):
+    shared_revocations = SharedRevocationSet(app.config['REVOCATION_SHM_PATH'],
+                                             app.config['REVOCATION_SHM_SLOTS'])
+# revoked jti -> exp of all replicas, synced from revocation_events
+revocation_log = None
+if app.config.get('REVOCATION_SYNC_INTERVAL') and app.config.get('REVOCATION_BACKEND', 'sql') == 'sql':
+    revocation_log = RevocationLog(app.config['REVOCATION_SYNC_INTERVAL'],
+                                   lookback=app.config['REVOCATION_SYNC_LOOKBACK'],
+                                   batch_size=app.config['REVOCATION_SYNC_BATCH'],
+                                   on_revoke_all=watermark_cache.invalidate)
+
+def denylist_mode():
+    """Only revoked jtis are stored, anything missing is still valid"""
+    return app.config.get('TOKEN_STORAGE_MODE') == 'denylist'
+
+
+def role_claims(user):
+    """Claims that let ``admin_required`` authorize without loading the user"""
+    return {
+        'role': user.roles.name if user.roles else None,
+        'role_ver': user.role_version or 0,
+    }
+
+
+def issue_token(identity, token_type, additional_claims=None):
+    """Create an access/refresh token and the ``tokens`` row describing it
+
+    jti and exp are chosen here and passed as claims, so the row can be
+    built without decoding the token that was just signed. ``iat_ms`` is
+    the issue time in milliseconds, compared with the revocation watermark
+    (iat only has a one second resolution).
+    """
+    jti = str(uuid.uuid4())
+    claims = dict(additional_claims or {})
+    claims['iat_ms'] = time.time() * 1000
+    if token_type == 'access':
+        expires = datetime.now(timezone.utc) + app.config['JWT_ACCESS_TOKEN_EXPIRES']
+        claims.update({'jti': jti, 'exp': expires})
+        encoded_token = create_access_token(identity=identity, additional_claims=claims)
+    else:
+        expires = datetime.now(timezone.utc) + app.config['JWT_REFRESH_TOKEN_EXPIRES']
+        claims.update({'jti': jti, 'exp': expires})
+        encoded_token = create_refresh_token(identity=identity, additional_claims=claims)
+
+    record = {
+        'jti': jti,
+        'token_type': token_type,
+        'user_uuid': identity,
+        # same second resolution as the exp claim
+        'expires': datetime.fromtimestamp(int(expires.timestamp())),
+        'revoked': False,
+    }
+    return encoded_token, record
 
-def add_token_to_database(encoded_token, identity_claim):
-    decoded_token = decode_token(encoded_token)
-    jti = decoded_token["jti"]
-    token_type = decoded_token["type"]
-    user_identity = decoded_token[identity_claim]
-    expires = datetime.fromtimestamp(decoded_token["exp"])
-    revoked = False
-
-    db_token = Token(
-        jti=jti,
-        token_type=token_type,
-        user_uuid=user_identity,
-        expires=expires,
-        revoked=revoked,
+
+def _mark_users_written(records):
+    for user_uuid in set(record['user_uuid'] for record in records):
+        mark_written(app, user_uuid)
+
+
+def _write_token_records(records):
+    # its own connection: a flush may run inside a request
+    with db.engine.begin() as connection:
+        connection.execute(Token.__table__.insert(), records)
+
+
+token_writer = None
+if app.config.get('TOKEN_WRITE_BEHIND') and app.config.get('REVOCATION_BACKEND', 'sql') == 'sql':
+    token_writer = TokenWriter(
+        _write_token_records,
+        max_size=app.config['TOKEN_WRITE_BEHIND_QUEUE_SIZE'],
+        batch_size=app.config['TOKEN_WRITE_BEHIND_BATCH'],
+        interval=app.config['TOKEN_WRITE_BEHIND_INTERVAL'],
+        put_timeout=app.config['TOKEN_WRITE_BEHIND_PUT_TIMEOUT'],
+        on_written=_mark_users_written,
+        logger=app.logger,
     )
-    db.session.add(db_token)
+
+
+# REVOCATION_BACKEND, see api/v1/revocation.py
+revocation_backend = create_backend(app.config, denylist=denylist_mode, writer=token_writer)
+
+
+def add_tokens_to_database(records):
+    """Persist the rows built by ``issue_token``
+
+    With the sql backend they go in one insert and one commit, together
+    with changes already pending on the session (e.g. a rehashed
+    password); those are committed here for the other backends, or when
+    a ``token_writer`` queued the rows.
+    """
+    revocation_backend.add(records)
+    if db.session.dirty:
+        db.session.commit()
+
+
+def tokens_valid_after(user_identity):
+    """Revocation watermark of a user, cached for TOKEN_WATERMARK_TTL seconds
+
+    0 when nothing was revoked in bulk, infinity when the user does not
+    exist (any more), so the tokens of a deleted user are all revoked.
+    """
+    watermark = watermark_cache.get(user_identity)
+    if watermark is None:
+        watermark = run_read_only(
+            db,
+            queries.tokens_valid_after, user_identity,
+            sticky_key=user_identity
+        )
+        if watermark is None and replica_keys(app):
+            # a replica may not have a new user yet
+            watermark = queries.tokens_valid_after(user_identity)
+        watermark = _cache_watermark(user_identity, watermark)
+    return watermark
+
+
+def _cache_watermark(user_identity, watermark):
+    if watermark is None:
+        watermark = float('inf')
+    watermark_cache.set(user_identity, watermark,
+                        time.time() + app.config.get('TOKEN_WATERMARK_TTL', 0))
+    return watermark
+
+
+def tokens_valid_after_many(user_identities):
+    """Watermarks of many users, as ``tokens_valid_after``, with a single
+    ``IN`` query for the ones that are not cached
+
+    Returns a dict of user uuid -> watermark.
+    """
+    result = {}
+    missing = []
+    for user_identity in set(user_identities):
+        watermark = watermark_cache.get(user_identity)
+        if watermark is None:
+            missing.append(user_identity)
+        else:
+            result[user_identity] = watermark
+    if not missing:
+        return result
+    if all(may_read_replica(app, user_identity) for user_identity in missing):
+        stored = run_read_only(db, queries.tokens_valid_after_many, missing)
+        if len(stored) < len(missing):
+            # a replica may not have the new users yet
+            stored.update(queries.tokens_valid_after_many(
+                [user_identity for user_identity in missing if user_identity not in stored]))
+    else:
+        stored = queries.tokens_valid_after_many(missing)
+    for user_identity in missing:
+        result[user_identity] = _cache_watermark(user_identity, stored.get(user_identity))
+    return result
+
+
+def issued_before_watermark(jwt_payload, watermarks=None):
+    """True if the token was issued before its user's watermark, taken from
+    ``watermarks`` (see ``tokens_valid_after_many``) when given
+    """
+    user_identity = jwt_payload.get(app.config['JWT_IDENTITY_CLAIM'])
+    if user_identity is None or "iat" not in jwt_payload:
+        return False
+    if "iat_ms" in jwt_payload:
+        issued_at = jwt_payload["iat_ms"] / 1000
+    else:
+        # tokens issued without it count from the start of their second
+        issued_at = jwt_payload["iat"]
+    if watermarks is None:
+        return issued_at < tokens_valid_after(user_identity)
+    return issued_at < watermarks[user_identity]
+
+
+def add_revoke_all_event(user_identity):
+    """Tell the synced workers to re-read the watermark of a user, no-op
+    while revocation sync is off
+    """
+    if sync_enabled():
+        db.session.add(RevocationEvent(
+            user_uuid=user_identity,
+            expires=datetime.now() + max(app.config['JWT_ACCESS_TOKEN_EXPIRES'],
+                                         app.config['JWT_REFRESH_TOKEN_EXPIRES']),
+        ))
+
+
+def revoke_all_tokens(user_identity):
+    """Revoke every token issued to a user so far with a single UPDATE
+
+    The watermark is the current time with sub-second precision, matched
+    against the ``iat_ms`` claim, so a login right after it is not
+    rejected. Returns False if there is no such user.
+    """
+    updated = User.query.filter_by(uuid=user_identity) \
+                        .update({User.tokens_valid_after: time.time()},
+                                synchronize_session=False)
+    if updated:
+        add_revoke_all_event(user_identity)
     db.session.commit()
+    watermark_cache.invalidate(user_identity)
+    mark_written(app, user_identity)
+    return updated > 0
 
 
-def is_token_revoked(jwt_payload):
-    jti = jwt_payload["jti"]
+def warm_shared_revocations():
+    """Load the revoked, unexpired jtis into the shared set once per node"""
+    if shared_revocations is None:
+        return
     try:
-        token = Token.query.filter_by(jti=jti).one()
-        return token.revoked
-    except NoResultFound:
+        if shared_revocations.warm(revocation_backend.revocations):
+            app.logger.info('shared revocation set warmed: %s', shared_revocations.stats())
+    except Exception as err:
+        # not complete, so it is only trusted for hits until a later warm-up
+        app.logger.warning('could not warm the shared revocation set: %s', err)
+
+
+def share_revocation(jti, expires):
+    """Let the other workers of this node, and this worker's synced log, know at once"""
+    if expires is None:
+        return
+    if revocation_log is not None:
+        revocation_log.add(jti, expires.timestamp())
+    if shared_revocations is not None:
+        if not shared_revocations.add(jti, expires.timestamp()):
+            app.logger.warning('shared revocation set is full, raise REVOCATION_SHM_SLOTS')
+
+
+def shared_revocation_state(jti):
+    """True/False when the shared set can answer for ``jti``, else None"""
+    if shared_revocations is None:
+        return None
+    if shared_revocations.contains(jti):
         return True
+    if denylist_mode() and app.config.get('REVOCATION_SHM_AUTHORITATIVE') \
+            and shared_revocations.complete():
+        return False
+    return None
 
 
-def revoke_token(token_jti, user):
-    try:
-        token = Token.query.filter_by(jti=token_jti, user_uuid=user).one()
-        token.revoked = True
-        db.session.commit()
-    except NoResultFound:
-        raise Exception("Could not find the token {}".format(token_jti))
+def start_revocation_sync():
+    if revocation_log is not None:
+        revocation_log.start()
+
+
+def synced_revocation_state(jti):
+    """True/False when the synced revocation log can answer for ``jti``, else None"""
+    if revocation_log is None:
+        return None
+    if revocation_log.contains(jti):
+        return True
+    # in allowlist mode a jti must also have a row, only the database knows
+    if denylist_mode() and revocation_log.fresh():
+        return False
+    return None
+
+
+def maybe_unflushed(jwt_payload):
+    """True for a recent token whose row another worker may still have queued"""
+    if token_writer is None or denylist_mode():
+        return False
+    return jwt_payload.get("iat", 0) > time.time() - app.config['TOKEN_WRITE_BEHIND_GRACE']
+
+
+def cache_token_state(jwt_payload, revoked, stale=False):
+    """Cache the revocation state of a token until its exp, a non-revoked
+    state for at most TOKEN_CACHE_TTL seconds
+
+    A non-revoked state read from a copy that may lag (``stale``, e.g. a
+    replica) is not cached at all, whatever TOKEN_CACHE_TTL is: the next
+    request asks again instead of missing a revocation that has not
+    replicated yet until exp.
+    """
+    if "exp" not in jwt_payload or (stale and not revoked):
+        return
+    expires_at = jwt_payload["exp"]
+    max_ttl = app.config.get('TOKEN_CACHE_TTL')
+    if max_ttl and not revoked:
+        expires_at = min(expires_at, time.time() + max_ttl)
+    token_cache.set(jwt_payload["jti"], revoked, expires_at)
+
+
+def is_token_revoked(jwt_payload):
+    if issued_before_watermark(jwt_payload):
+        return True
+
+    jti = jwt_payload["jti"]
+    # before the per-worker cache, which may still hold a revoked jti as valid
+    revoked = shared_revocation_state(jti)
+    if revoked is None:
+        revoked = synced_revocation_state(jti)
+    if revoked is not None:
+        return revoked
+
+    revoked = token_cache.get(jti)
+    if revoked is not None:
+        TOKEN_CACHE_LOOKUPS.labels('hit').inc()
+        return revoked
+    TOKEN_CACHE_LOOKUPS.labels('miss').inc()
+    if token_writer is not None and token_writer.is_pending(jti):
+        # issued here, its row is not written yet
+        return False
+
+    user_identity = jwt_payload.get(app.config['JWT_IDENTITY_CLAIM'])
+    revoked = revocation_backend.is_revoked(jti, user_identity)
+    if revoked is None:
+        if maybe_unflushed(jwt_payload):
+            # not cached, the row is looked for again on the next request
+            return False
+        # an unknown jti is still valid in denylist mode only
+        revoked = not denylist_mode()
+
+    cache_token_state(jwt_payload, revoked, stale=revocation_backend.may_be_stale(user_identity))
+    return revoked
+
+
+def revoked_jtis(jwt_payloads):
+    """Revocation state for many tokens, with one backend lookup (an ``IN``
+    query for the sql backend) for the jtis that are not in the token cache
+    and one query for the watermarks of their users
+
+    Returns a dict of jti -> revoked.
+    """
+    result = {}
+    missing = {}
+    identity_claim = app.config['JWT_IDENTITY_CLAIM']
+    watermarks = tokens_valid_after_many(
+        jwt_payload[identity_claim] for jwt_payload in jwt_payloads if identity_claim in jwt_payload)
+    for jwt_payload in jwt_payloads:
+        jti = jwt_payload["jti"]
+        if issued_before_watermark(jwt_payload, watermarks):
+            result[jti] = True
+            continue
+        revoked = shared_revocation_state(jti)
+        if revoked is None:
+            revoked = synced_revocation_state(jti)
+        if revoked is not None:
+            result[jti] = revoked
+            continue
+        revoked = token_cache.get(jti)
+        if revoked is None:
+            TOKEN_CACHE_LOOKUPS.labels('miss').inc()
+            missing[jti] = jwt_payload
+        else:
+            TOKEN_CACHE_LOOKUPS.labels('hit').inc()
+            result[jti] = revoked
+    if not missing:
+        return result
+
+    stored = revocation_backend.is_revoked_many(list(missing))
+    for jti, jwt_payload in missing.items():
+        revoked = stored.get(jti)
+        if revoked is None and (token_writer is not None and token_writer.is_pending(jti)
+                                or maybe_unflushed(jwt_payload)):
+            result[jti] = False
+            continue
+        if revoked is None:
+            revoked = not denylist_mode()
+        result[jti] = revoked
+        cache_token_state(jwt_payload, revoked)
+    return result
+
+
+def revoke_token(token_jti, user, token_type=None, expires=None):
+    if token_writer is not None and token_writer.is_pending(token_jti):
+        token_writer.flush()
+    expires = revocation_backend.revoke(token_jti, user, token_type=token_type, expires=expires)
+    share_revocation(token_jti, expires)
+    token_cache.invalidate(token_jti)
+
+
+def purge_expired_tokens(chunk_size=1000, pause=0.1, dry_run=False, model=None):
+    """Delete expired tokens from the revocation backend, or expired rows
+    of ``model``, in bounded chunks
+    """
+    if model is not None:
+        return purge_expired_rows(model, chunk_size=chunk_size, pause=pause, dry_run=dry_run)
+    return revocation_backend.purge_expired(chunk_size=chunk_size, pause=pause, dry_run=dry_run)
+
+
+def current_role_version(user_identity):
+    """Role version of a user, cached for ROLE_VERSION_TTL seconds"""
+    version = role_version_cache.get(user_identity)
+    if version is None:
+        version = run_read_only(
+            db,
+            queries.role_version, user_identity,
+            sticky_key=user_identity
+        )
+        if version is None:
+            return None
+        role_version_cache.set(user_identity, version,
+                               time.time() + app.config.get('ROLE_VERSION_TTL', 0))
+    return version
+
 
 def admin_required():
     def wrapper(fn):
@@ -56,7 +435,12 @@ def admin_required():
         def decorator(*args, **kwargs):
             verify_jwt_in_request()
             user_identity = get_jwt_identity()
-            role_name = User.query.filter_by(uuid=user_identity).first().roles.name
+            claims = get_jwt()
+            role_name = claims.get('role')
+            if role_name is None or claims.get('role_ver') != current_role_version(user_identity):
+                # token predates role claims or the role changed since it was issued
+                user = current_user()
+                role_name = user.roles.name if user and user.roles else None
             if role_name == "Admin" :
                 return fn(*args, **kwargs)
             else:
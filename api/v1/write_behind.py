@@ -0,0 +1,161 @@
+"""Write-behind persistence of issued tokens
+
+With TOKEN_WRITE_BEHIND on, login and refresh hand their ``tokens`` rows
+to a per-worker queue and return without waiting for a commit. A daemon
+thread writes them in multi-row inserts as soon as TOKEN_WRITE_BEHIND_BATCH
+rows are waiting or TOKEN_WRITE_BEHIND_INTERVAL seconds have passed, on its
+own connection so a flush never touches a request's session.
+
+When TOKEN_WRITE_BEHIND_QUEUE_SIZE rows are waiting, a request blocks for
+up to TOKEN_WRITE_BEHIND_PUT_TIMEOUT seconds and then flushes inline, so a
+slow database slows logins down instead of growing the queue or dropping
+tokens. Rows still queued are flushed at exit (atexit and gunicorn's
+worker_exit). A worker that is killed loses them, and their tokens then
+stop working once TOKEN_WRITE_BEHIND_GRACE has passed.
+
+Queued jtis are valid in the worker that issued them. Other workers and
+replicas cannot see them: for TOKEN_WRITE_BEHIND_GRACE seconds after its
+iat a token without a row is trusted rather than treated as revoked, and
+a revoke of such a token stores a revoked row that the later insert of the
+queued row will not overwrite.
+"""
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
+import atexit
+import os
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from metrics import TOKEN_FLUSH_DURATION, TOKEN_FLUSH_ROWS, TOKEN_QUEUE_DEPTH, TOKEN_QUEUE_FULL
+
+
+class TokenWriter(object):
+    """Bounded queue of token rows flushed by ``write(rows)`` in batches"""
+
+    def __init__(self, write, max_size=10000, batch_size=500, interval=0.2, put_timeout=0.05,
+                 on_written=None, logger=None):
+        self.write = write
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.put_timeout = put_timeout
+        # called with the rows of every successful flush
+        self.on_written = on_written
+        self.logger = logger
+        self._queue = OrderedDict()
+        self._cond = Condition()
+        self._flush_lock = Lock()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+
+    def _ensure_thread(self):
+        # threads do not survive gunicorn's fork, start one per worker
+        if self._pid != os.getpid():
+            with self._cond:
+                if self._pid != os.getpid():
+                    self._queue.clear()
+                    self._closed = False
+                    self._pid = os.getpid()
+                    self._thread = Thread(target=self._run, name='token-writer', daemon=True)
+                    self._thread.start()
+                    atexit.register(self.close)
+
+    def is_pending(self, jti):
+        return jti in self._queue
+
+    def __len__(self):
+        return len(self._queue)
+
+    def submit(self, records):
+        self._ensure_thread()
+        with self._cond:
+            if len(self._queue) + len(records) > self.max_size:
+                TOKEN_QUEUE_FULL.labels('waited').inc()
+                deadline = time.monotonic() + self.put_timeout
+                while len(self._queue) + len(records) > self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            full = len(self._queue) + len(records) > self.max_size
+            for record in records:
+                self._queue[record['jti']] = record
+            TOKEN_QUEUE_DEPTH.set(len(self._queue))
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+        if full:
+            TOKEN_QUEUE_FULL.labels('flushed_inline').inc()
+            self.flush()
+        elif self._closed:
+            # shutting down, nobody else will write them
+            self.flush()
+
+    def _batch(self):
+        with self._cond:
+            return [record for _, record in zip(range(self.batch_size), self._queue.values())]
+
+    def _write_batch(self, batch):
+        with TOKEN_FLUSH_DURATION.time():
+            try:
+                self.write(batch)
+                written = batch
+            except IntegrityError:
+                # a row revoked by another worker before we flushed it, or
+                # whose user is gone: write the others one by one
+                written = []
+                for record in batch:
+                    try:
+                        self.write([record])
+                        written.append(record)
+                    except IntegrityError:
+                        TOKEN_FLUSH_ROWS.labels('dropped').inc()
+                        if self.logger is not None:
+                            self.logger.info('token %s not flushed: row exists or user is gone',
+                                             record['jti'])
+        TOKEN_FLUSH_ROWS.labels('written').inc(len(written))
+        if written and self.on_written is not None:
+            self.on_written(written)
+
+    def flush(self):
+        """Write every queued row, returns how many rows left the queue"""
+        flushed = 0
+        with self._flush_lock:
+            while True:
+                batch = self._batch()
+                if not batch:
+                    break
+                # rows stay queued, hence valid here, until they are written
+                self._write_batch(batch)
+                with self._cond:
+                    for record in batch:
+                        self._queue.pop(record['jti'], None)
+                    TOKEN_QUEUE_DEPTH.set(len(self._queue))
+                    self._cond.notify_all()
+                flushed += len(batch)
+        return flushed
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._queue) < self.batch_size:
+                    self._cond.wait(self.interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception as err:
+                # the rows stay queued, retried on the next round
+                if self.logger is not None:
+                    self.logger.warning('token flush failed, %d rows queued: %s', len(self._queue), err)
+                time.sleep(self.interval)
+
+    def close(self):
+        """Stop the flush thread and write what is left"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        return self.flush()
@@ -0,0 +1,117 @@
+"""Throughput and latency of the auth endpoints
+
+    python -m benchmarks.auth_endpoints --users 10000 --iterations 200
+    python -m benchmarks.auth_endpoints --threads 8 --output before.json
+
+Seeds ``--users`` users into a fresh SQLite database, then every client
+thread repeats: login, me, refresh, GET users (as admin), POST users (as
+admin) and logout, through the Flask test client. Reports ops/sec and
+p50/p95/p99 per endpoint plus the overall requests/sec as JSON; with ``--threads`` > 1 the clients run
+concurrently, which also exercises SQLite lock and commit contention
+(failed requests are counted as errors).
+"""
+import argparse
+import json
+import random
+import threading
+import time
+
+from benchmarks.common import git_revision, seed_users, setup_database, summarize, teardown_database
+
+ENDPOINTS = ['login', 'me', 'refresh', 'users_get', 'users_post', 'logout']
+PASSWORD = 'pass1234'
+# guards the error counts, which every client thread increments
+errors_lock = threading.Lock()
+
+
+def run_client(app, client_id, iterations, user_count, results, errors):
+    client = app.test_client()
+    rnd = random.Random(client_id)
+
+    def call(name, fn, expected=200):
+        start = time.perf_counter()
+        rv = fn()
+        elapsed = time.perf_counter() - start
+        if rv.status_code != expected:
+            with errors_lock:
+                errors[name] += 1
+            return None
+        results[name].append(elapsed)
+        return rv
+
+    rv = client.post('/api/v1/accounts/login', json={'username': 'bench_admin_0', 'password': PASSWORD})
+    admin = {'Authorization': 'Bearer ' + rv.get_json()['data']['access_token']}
+
+    for i in range(iterations):
+        username = 'bench_{}'.format(rnd.randrange(user_count))
+        rv = call('login', lambda: client.post('/api/v1/accounts/login',
+                                               json={'username': username, 'password': PASSWORD}))
+        if rv is None:
+            continue
+        tokens = rv.get_json()['data']
+        access = {'Authorization': 'Bearer ' + tokens['access_token']}
+        refresh = {'Authorization': 'Bearer ' + tokens['refresh_token']}
+
+        call('me', lambda: client.get('/api/v1/accounts/me', headers=access))
+        call('refresh', lambda: client.post('/api/v1/accounts/refresh', headers=refresh))
+        call('users_get', lambda: client.get('/api/v1/users?limit=50', headers=admin))
+        new_user = 'bench_new_{}_{}'.format(client_id, i)
+        call('users_post', lambda: client.post('/api/v1/users', headers=admin, json={
+            'username': new_user,
+            'password': PASSWORD,
+            'email': new_user + '@email.com',
+            'name': new_user,
+            'role_name': 'User',
+        }), expected=201)
+        call('logout', lambda: client.delete('/api/v1/accounts/logout', headers=access))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000, help='seeded users')
+    parser.add_argument('--iterations', type=int, default=100, help='scenario rounds per thread')
+    parser.add_argument('--threads', type=int, default=1, help='concurrent client threads')
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    app, db = setup_database()
+    seed_users(args.users, PASSWORD)
+    seed_users(1, PASSWORD, prefix='bench_admin', role_name='Admin')
+
+    results = {name: [] for name in ENDPOINTS}
+    errors = {name: 0 for name in ENDPOINTS}
+    threads = [threading.Thread(target=run_client,
+                                args=(app, i, args.iterations, args.users, results, errors))
+               for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    teardown_database()
+
+    report = {
+        'revision': git_revision(),
+        'users': args.users,
+        'threads': args.threads,
+        'iterations': args.iterations,
+        'wall_seconds': round(wall, 3),
+        'endpoints': {},
+    }
+    for name in ENDPOINTS:
+        summary = summarize(results[name]) if results[name] else {'iterations': 0}
+        summary['errors'] = errors[name]
+        report['endpoints'][name] = summary
+    # per endpoint ops_per_sec is the rate of one client, this is all threads together
+    report['requests_per_sec'] = round(sum(len(latencies) for latencies in results.values()) / wall, 1)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Shared setup for the benchmark scripts
+
+The scripts run against ``config.BenchConfig`` (a throwaway SQLite file) so
+they never touch the dev or test databases.
+"""
+from contextlib import contextmanager
+import os
+import subprocess
+import time
+
+os.environ['CONFIG_ENV'] = 'config.BenchConfig'
+os.environ.setdefault('SECRET_KEY', 'bench-secret-key-not-for-production-use')
+
+from main import app, db
+from models.roles import Role
+from models.users import User
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+
+def setup_database():
+    db.drop_all()
+    db.create_all()
+    Role.generate_default_roles()
+    return app, db
+
+
+def seed_users(count, password, prefix='bench', role_name='User', batch_size=5000):
+    """Insert ``count`` users sharing one precomputed password hash"""
+    pwhash = generate_password_hash(password, app.config['PASSWORD_HASH_METHOD'] + ':' +
+                                    str(app.config['PASSWORD_HASH_ITERATIONS']))
+    User.generate_synthetic_users(count, pwhash, prefix=prefix, role_name=role_name, batch_size=batch_size)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def teardown_database():
+    db.session.remove()
+    db.drop_all()
+
+
+@contextmanager
+def count_queries():
+    """Collect the SQL statements executed inside the block"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def timed(fn, iterations):
+    """Run ``fn`` ``iterations`` times, returning per-call latencies in seconds"""
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def summarize(latencies):
+    ordered = sorted(latencies)
+    total = sum(ordered)
+
+    def percentile(p):
+        index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        'iterations': len(ordered),
+        'ops_per_sec': round(len(ordered) / total, 1) if total else 0.0,
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+    }
@@ -0,0 +1,84 @@
+"""Per-query overhead of the hot auth queries: Model.query vs api.v1.queries
+
+    python -m benchmarks.hot_queries --users 10000 --tokens 50000 --iterations 2000
+
+Both sides run against the same SQLite file, so the difference is the
+statement construction, compilation and ORM loading that each call pays,
+not the database.
+"""
+import argparse
+import json
+import random
+from functools import partial
+
+from benchmarks.common import setup_database, teardown_database, timed, summarize, git_revision
+from sqlalchemy.orm import joinedload
+from werkzeug.security import generate_password_hash
+from api.v1 import queries
+from models.tokens import Token
+from models.users import User
+
+
+def legacy_token_revoked(jti):
+    token = Token.query.filter_by(jti=jti).first()
+    return token.revoked if token else None
+
+
+def legacy_user_by_uuid(uuid):
+    return User.query.options(joinedload(User.roles)).filter_by(uuid=uuid).first()
+
+
+def legacy_user_by_username(username):
+    return User.query.filter_by(username=username).first()
+
+
+def legacy_role_version(uuid):
+    return User.query.filter_by(uuid=uuid).first().role_version
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--tokens', type=int, default=50000)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    app, db = setup_database()
+    User.generate_synthetic_users(args.users, generate_password_hash('x', 'pbkdf2:sha256:1'), prefix='bench')
+    Token.generate_synthetic_tokens(args.tokens, args.users, partial(User.synthetic_uuid, 'bench'))
+    jtis = [jti for jti, in db.session.query(Token.jti).limit(1000)]
+    uuids = [User.synthetic_uuid('bench', i) for i in range(min(args.users, 1000))]
+    usernames = ['bench_{}'.format(i) for i in range(min(args.users, 1000))]
+
+    cases = [
+        ('token_revoked', legacy_token_revoked, queries.token_revoked, jtis),
+        ('user_by_uuid', legacy_user_by_uuid, queries.user_by_uuid, uuids),
+        ('user_by_username', legacy_user_by_username, queries.user_by_username, usernames),
+        ('role_version', legacy_role_version, queries.role_version, uuids),
+    ]
+    results = {'revision': git_revision(), 'users': args.users, 'tokens': args.tokens}
+    with app.test_request_context():
+        for name, legacy, hot, keys in cases:
+            def run(fn):
+                key = random.choice(keys)
+                fn(key)
+                # measure the query, not the identity map
+                db.session.expunge_all()
+
+            for _ in range(50):
+                # compile and cache both forms before measuring
+                run(legacy)
+                run(hot)
+            before = summarize(timed(partial(run, legacy), args.iterations))
+            after = summarize(timed(partial(run, hot), args.iterations))
+            results[name] = {
+                'model_query': before,
+                'hot_query': after,
+                'p50_speedup': round(before['p50_ms'] / after['p50_ms'], 2) if after['p50_ms'] else None,
+            }
+    teardown_database()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
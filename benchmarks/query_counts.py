@@ -0,0 +1,68 @@
+"""SQL statements executed per request on the protected endpoints
+
+    python -m benchmarks.query_counts
+
+Each endpoint is measured twice: with a cold in-process token/role cache
+and with the caches warm, which is the steady state of a worker.
+"""
+import json
+import uuid
+
+from benchmarks.common import setup_database, teardown_database, count_queries
+from werkzeug.security import generate_password_hash
+from api.v1.utils import token_cache, role_version_cache
+from models.roles import Role
+from models.users import User
+
+
+def main():
+    app, db = setup_database()
+    admin_role = Role.query.filter_by(name='Admin').first()
+    db.session.add(User(uuid=uuid.uuid4().hex, username='bench_admin', email='bench@email.com',
+                        name='bench', password=generate_password_hash('pass1234'),
+                        role_id=admin_role.id))
+    db.session.commit()
+
+    client = app.test_client()
+
+    def login():
+        rv = client.post('/api/v1/accounts/login',
+                         json={'username': 'bench_admin', 'password': 'pass1234'})
+        tokens = rv.get_json()['data']
+        return ({'Authorization': 'Bearer ' + tokens['access_token']},
+                {'Authorization': 'Bearer ' + tokens['refresh_token']})
+
+    # (name, warm-up request, measured request), both get fresh (access, refresh) headers
+    me = lambda access, refresh: client.get('/api/v1/accounts/me', headers=access)
+    endpoints = [
+        ('GET /api/v1/accounts/me', me, me),
+        ('GET /api/v1/users',
+         lambda access, refresh: client.get('/api/v1/users', headers=access),
+         lambda access, refresh: client.get('/api/v1/users', headers=access)),
+        ('POST /api/v1/accounts/refresh',
+         lambda access, refresh: client.post('/api/v1/accounts/refresh', headers=refresh),
+         lambda access, refresh: client.post('/api/v1/accounts/refresh', headers=refresh)),
+        ('DELETE /api/v1/accounts/logout', me,
+         lambda access, refresh: client.delete('/api/v1/accounts/logout', headers=access)),
+    ]
+    results = {}
+    for name, warm_up, measured in endpoints:
+        counts = {}
+        for state in ('cold', 'warm'):
+            access, refresh = login()
+            token_cache.clear()
+            role_version_cache.clear()
+            if state == 'warm':
+                warm_up(access, refresh)
+            db.session.remove()
+            with count_queries() as statements:
+                rv = measured(access, refresh)
+            assert rv.status_code == 200, (name, rv.get_json())
+            counts[state] = len(statements)
+        results[name] = counts
+    teardown_database()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Throughput of the revocation backends (REVOCATION_BACKEND)
+
+    python -m benchmarks.revocation_backends --users 1000 --tokens 20000 --iterations 2000
+
+Every backend is preloaded with the same ``--tokens`` rows, then measured
+on single-token add (a login), is_revoked (every authenticated request)
+and revoke (a logout). The sql backend runs on the benchmark SQLite file,
+so its numbers are a floor for MySQL, where each call is a round trip.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+
+from benchmarks.common import setup_database, teardown_database, timed, summarize, git_revision
+from werkzeug.security import generate_password_hash
+from api.v1.revocation import MemoryRevocationBackend, SQLRevocationBackend, SQLiteRevocationBackend
+from models.users import User
+
+
+def token_record(user_uuid):
+    return {
+        'jti': str(uuid.uuid4()),
+        'token_type': 'access',
+        'user_uuid': user_uuid,
+        'expires': datetime.now() + timedelta(hours=1),
+        'revoked': False,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--tokens', type=int, default=20000)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    app, db = setup_database()
+    User.generate_synthetic_users(args.users, generate_password_hash('x', 'pbkdf2:sha256:1'), prefix='bench')
+    uuids = [User.synthetic_uuid('bench', i) for i in range(args.users)]
+    preload = [token_record(random.choice(uuids)) for _ in range(args.tokens)]
+
+    directory = tempfile.mkdtemp()
+    backends = [
+        ('sql', SQLRevocationBackend()),
+        ('memory', MemoryRevocationBackend()),
+        ('sqlite', SQLiteRevocationBackend(os.path.join(directory, 'revocations.db'))),
+    ]
+    results = {'revision': git_revision(), 'users': args.users, 'tokens': args.tokens}
+    with app.test_request_context():
+        for name, backend in backends:
+            for start in range(0, len(preload), 5000):
+                backend.add(preload[start:start + 5000])
+            issued = []
+
+            def add():
+                record = token_record(random.choice(uuids))
+                backend.add([record])
+                issued.append(record)
+
+            def is_revoked():
+                backend.is_revoked(random.choice(preload)['jti'])
+
+            def revoke():
+                record = issued.pop()
+                backend.revoke(record['jti'], record['user_uuid'])
+
+            results[name] = {
+                'add': summarize(timed(add, args.iterations)),
+                'is_revoked': summarize(timed(is_revoked, args.iterations)),
+                'revoke': summarize(timed(revoke, args.iterations)),
+            }
+    teardown_database()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
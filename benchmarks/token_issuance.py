@@ -0,0 +1,66 @@
+"""Token issuance per login: decode-and-commit-each vs one batched insert
+
+    python -m benchmarks.token_issuance --iterations 500
+"""
+import argparse
+import json
+import uuid
+
+from benchmarks.common import setup_database, teardown_database, timed, summarize
+from datetime import datetime
+
+from flask_jwt_extended import create_access_token, create_refresh_token, decode_token
+from api.v1.utils import add_tokens_to_database, issue_token
+from models.users import User
+
+
+def decode_and_add(encoded_token):
+    """The old per-token path: decode what was just encoded, commit alone"""
+    decoded_token = decode_token(encoded_token)
+    add_tokens_to_database([{
+        'jti': decoded_token['jti'],
+        'token_type': decoded_token['type'],
+        'user_uuid': decoded_token['sub'],
+        'expires': datetime.fromtimestamp(decoded_token['exp']),
+        'revoked': False,
+    }])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=500)
+    args = parser.parse_args()
+
+    app, db = setup_database()
+    with app.test_request_context():
+        user = User(uuid=uuid.uuid4().hex, username='bench', email='bench@email.com',
+                    name='bench', password='x', role_id=2)
+        db.session.add(user)
+        db.session.commit()
+        identity = user.uuid
+
+        def decode_and_commit_each():
+            access_token = create_access_token(identity=identity)
+            refresh_token = create_refresh_token(identity=identity)
+            decode_and_add(access_token)
+            decode_and_add(refresh_token)
+
+        def single_transaction():
+            access_token, access_record = issue_token(identity, 'access')
+            refresh_token, refresh_record = issue_token(identity, 'refresh')
+            add_tokens_to_database([access_record, refresh_record])
+
+        results = {
+            'decode_and_commit_each': summarize(timed(decode_and_commit_each, args.iterations)),
+            'single_transaction': summarize(timed(single_transaction, args.iterations)),
+        }
+    teardown_database()
+
+    before = results['decode_and_commit_each']['ops_per_sec']
+    after = results['single_transaction']['ops_per_sec']
+    results['speedup'] = round(after / before, 2) if before else None
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,16 @@
 from datetime import timedelta
+from database import InstrumentedQueuePool
 import os
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+def replica_binds(user, password, hosts, name):
+    """SQLALCHEMY_BINDS entries for a comma separated list of replica hosts"""
+    return {
+        'replica_{}'.format(i): 'mysql+pymysql://{}:{}@{}/{}'.format(user, password, host.strip(), name)
+        for i, host in enumerate(hosts.split(',')) if host.strip()
+    }
+
 class BaseConfig(object):
     JWT_SECRET_KEY = os.environ.get('SECRET_KEY')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
@@ -10,6 +18,102 @@ class BaseConfig(object):
     DEVELOPMENT = True
     JSON_SORT_KEYS = False
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=1)
+    # HS256 signs with SECRET_KEY; RS256/ES256/EdDSA sign with the <kid>.pem
+    # keys in JWT_KEYS_DIR, published at /.well-known/jwks.json
+    JWT_ALGORITHM = os.environ.get('JWT_ALGORITHM', 'HS256')
+    JWT_KEYS_DIR = os.environ.get('JWT_KEYS_DIR')
+    JWT_ACTIVE_KID = os.environ.get('JWT_ACTIVE_KID')
+    JWKS_MAX_AGE = int(os.environ.get('JWKS_MAX_AGE', 300))
+    # max jtis kept by the in-process blocklist cache, 0 disables it
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+    # caps how long a non-revoked entry is trusted. The cache is per worker
+    # and a logout only clears it in the worker that handled it, so with
+    # several workers or replicas a revoked token keeps working elsewhere
+    # for up to this many seconds. 0 trusts it until exp (up to
+    # JWT_ACCESS_TOKEN_EXPIRES), only safe with a single worker process
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 5))
+    # 'allowlist' stores every issued token, 'denylist' only revoked ones
+    TOKEN_STORAGE_MODE = os.environ.get('TOKEN_STORAGE_MODE', 'allowlist')
+    # GET /api/v1/users page sizes and server-side cursor batch for ?stream=1
+    USERS_PAGE_LIMIT = int(os.environ.get('USERS_PAGE_LIMIT', 100))
+    USERS_PAGE_MAX_LIMIT = int(os.environ.get('USERS_PAGE_MAX_LIMIT', 1000))
+    USERS_STREAM_BATCH = int(os.environ.get('USERS_STREAM_BATCH', 500))
+    # process pool for password hashing, 0 hashes on the request thread;
+    # only pays off with several request threads per worker, see
+    # GUNICORN_WORKER_CLASS (gthread) and GUNICORN_THREADS in gunicorn.conf.py
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 0))
+    PASSWORD_HASH_QUEUE_SIZE = int(os.environ.get('PASSWORD_HASH_QUEUE_SIZE', 16))
+    PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 5))
+    # hashes made with other parameters are upgraded on the next login,
+    # use `flask calibrate-password-hash` to pick the iterations
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+    PASSWORD_HASH_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 150000))
+    # role claims are trusted while the user's role_version matches, the
+    # version itself is cached this many seconds per worker
+    ROLE_VERSION_TTL = int(os.environ.get('ROLE_VERSION_TTL', 30))
+    ROLE_CACHE_SIZE = int(os.environ.get('ROLE_CACHE_SIZE', 10000))
+    # per-user "tokens valid after" watermarks are cached this many seconds
+    # per worker, so a revoke-all handled by another worker is seen within it
+    TOKEN_WATERMARK_TTL = int(os.environ.get('TOKEN_WATERMARK_TTL', 10))
+    TOKEN_WATERMARK_CACHE_SIZE = int(os.environ.get('TOKEN_WATERMARK_CACHE_SIZE', 10000))
+    # max tokens per POST /api/v1/tokens/introspect
+    INTROSPECT_MAX_TOKENS = int(os.environ.get('INTROSPECT_MAX_TOKENS', 100))
+    # read-only queries go to the replica_* binds; reads for a user stay on
+    # the primary this long after a write for that user, a failing replica
+    # is skipped for REPLICA_RETRY_SECONDS
+    REPLICA_STICKINESS_SECONDS = float(os.environ.get('REPLICA_STICKINESS_SECONDS', 5))
+    REPLICA_RETRY_SECONDS = float(os.environ.get('REPLICA_RETRY_SECONDS', 30))
+    # per-request SQL profiling, Server-Timing header and slow request log
+    SQL_PROFILING = os.environ.get('SQL_PROFILING', 'False') == 'True'
+    SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 500))
+    SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+    # POST /api/v1/users/import, `flask import-users` takes its own options
+    BULK_IMPORT_BATCH_SIZE = int(os.environ.get('BULK_IMPORT_BATCH_SIZE', 1000))
+    BULK_IMPORT_WORKERS = int(os.environ.get('BULK_IMPORT_WORKERS', 0))
+    BULK_IMPORT_MAX_REJECTS = int(os.environ.get('BULK_IMPORT_MAX_REJECTS', 100))
+    # rows read per request: every password is hashed before the response
+    # (~0.1s each inline with BULK_IMPORT_WORKERS=0), keep it well under
+    # gunicorn's 30s timeout. 0 = no cap
+    BULK_IMPORT_MAX_ROWS = int(os.environ.get('BULK_IMPORT_MAX_ROWS', 200))
+    # revoked jtis shared by the workers of a node through a memory-mapped
+    # file (e.g. /dev/shm/sc-auth-revocations), off when unset. Use a new
+    # path when changing the slot count. In denylist mode with every
+    # revoking worker on the same node, AUTHORITATIVE trusts a miss
+    # without asking the database
+    REVOCATION_SHM_PATH = os.environ.get('REVOCATION_SHM_PATH')
+    REVOCATION_SHM_SLOTS = int(os.environ.get('REVOCATION_SHM_SLOTS', 262144))
+    REVOCATION_SHM_AUTHORITATIVE = os.environ.get('REVOCATION_SHM_AUTHORITATIVE', 'False') == 'True'
+    # every worker polls revocation_events this often (seconds, 0 = off) and
+    # answers revocation checks from memory, see api/v1/revocation_log.py
+    REVOCATION_SYNC_INTERVAL = float(os.environ.get('REVOCATION_SYNC_INTERVAL', 0))
+    REVOCATION_SYNC_LOOKBACK = int(os.environ.get('REVOCATION_SYNC_LOOKBACK', 100))
+    REVOCATION_SYNC_BATCH = int(os.environ.get('REVOCATION_SYNC_BATCH', 1000))
+    # allowlist mode: queue issued token rows and insert them in batches
+    # from a background thread, see api/v1/write_behind.py.
+    # Data loss: rows still queued when a worker is killed without a clean
+    # exit (SIGKILL, an OOM kill under the pod memory limit) are lost, up
+    # to QUEUE_SIZE tokens per worker. Their users are logged out once
+    # GRACE seconds have passed since the token was issued. Rows whose
+    # insert fails (e.g. the user was deleted meanwhile) are logged and
+    # dropped. Until GRACE has passed, any token without a row is accepted,
+    # except those of deleted users, which tokens_valid_after rejects
+    TOKEN_WRITE_BEHIND = os.environ.get('TOKEN_WRITE_BEHIND', 'False') == 'True'
+    TOKEN_WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get('TOKEN_WRITE_BEHIND_QUEUE_SIZE', 10000))
+    TOKEN_WRITE_BEHIND_BATCH = int(os.environ.get('TOKEN_WRITE_BEHIND_BATCH', 500))
+    TOKEN_WRITE_BEHIND_INTERVAL = float(os.environ.get('TOKEN_WRITE_BEHIND_INTERVAL', 0.2))
+    TOKEN_WRITE_BEHIND_PUT_TIMEOUT = float(os.environ.get('TOKEN_WRITE_BEHIND_PUT_TIMEOUT', 0.05))
+    TOKEN_WRITE_BEHIND_GRACE = float(os.environ.get('TOKEN_WRITE_BEHIND_GRACE', 10))
+    # where tokens are stored: 'sql' (the tokens table), 'memory' (single
+    # process only, gunicorn refuses it with more than one worker) or
+    # 'sqlite' (one file per node), see api/v1/revocation.py.
+    # Revocation sync and write-behind only apply to 'sql'
+    REVOCATION_BACKEND = os.environ.get('REVOCATION_BACKEND', 'sql')
+    # Prometheus metrics are served by the gunicorn master on this port
+    # (set in the Dockerfile), kept off the app port the ingress exposes.
+    # 0 serves them from the app at /metrics, for flask run and tests only
+    METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+    REVOCATION_SQLITE_PATH = os.environ.get('REVOCATION_SQLITE_PATH') or \
+        os.path.join(basedir, 'revocations.db')
     
 class DevConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
@@ -22,6 +126,11 @@ class TestConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'test_app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = True
 
+class BenchConfig(TestConfig):
+    DEBUG = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'bench_app.db')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
 class ProductionConfig(BaseConfig):
     DEBUG =  False
     DEVELOPMENT= False
@@ -29,4 +138,19 @@ class ProductionConfig(BaseConfig):
     DB_USER = os.environ.get('DB_USER') 
     DB_PASS = os.environ.get('DB_PASS')
     DB_NAME = os.environ.get('DB_NAME')
-    SQLALCHEMY_DATABASE_URI = 'mysql+pymysql://{}:{}@{}/{}'.format(DB_USER,DB_PASS,DB_HOST,DB_NAME)
\ No newline at end of file
+    SQLALCHEMY_DATABASE_URI = 'mysql+pymysql://{}:{}@{}/{}'.format(DB_USER,DB_PASS,DB_HOST,DB_NAME)
+    # optional read replicas, e.g. DB_REPLICA_HOSTS=replica-1,replica-2
+    SQLALCHEMY_BINDS = replica_binds(DB_USER, DB_PASS, os.environ.get('DB_REPLICA_HOSTS', ''), DB_NAME)
+    # per gunicorn worker: keep workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+    # below MySQL's max_connections, and DB_POOL_RECYCLE below wait_timeout
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 280)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', 'True') == 'True',
+        'connect_args': {
+            'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 5)),
+        },
+    }
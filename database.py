@@ -0,0 +1,222 @@
+"""Connection pool instrumentation and read-replica routing
+
+``InstrumentedQueuePool`` is a QueuePool that also records how long
+checkouts wait for a free connection and how often they time out.
+``pool_status`` reports it together with the live pool counters, to size
+pool_size/max_overflow against the number of gunicorn workers (each
+worker process has its own pool, so the database sees up to
+workers * (pool_size + max_overflow) connections).
+
+``RoutingSQLAlchemy`` sends the reads made inside ``replica_reads()`` (or a
+``read_only`` view) to one of the ``replica*`` binds, everything else to
+the primary. A replica that fails is skipped for REPLICA_RETRY_SECONDS and
+the read is retried on the primary. After a write, reads for the same key
+(a user uuid) stay on the primary for REPLICA_STICKINESS_SECONDS so that,
+e.g., the revocation check right after a logout sees the logout. That only
+holds within one worker process: other workers and pods may read the
+replica before the write reached it (see ``may_read_replica``).
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from threading import Lock
+import random
+import time
+
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.exc import OperationalError, TimeoutError
+from sqlalchemy.pool import QueuePool
+
+from api.v1.cache import TTLCache
+
+
+class PoolStats(object):
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = Lock()
+
+    def record(self, waited, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            if timed_out:
+                self.timeouts += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_avg_ms': round(self.wait_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super(InstrumentedQueuePool, self)._do_get()
+        except TimeoutError:
+            self.stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.stats.record(time.perf_counter() - start)
+        return connection
+
+
+def pool_status(engine):
+    pool = engine.pool
+    status = {'class': type(pool).__name__}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, name):
+            status[name] = getattr(pool, name)()
+    if isinstance(pool, QueuePool):
+        status['max_overflow'] = pool._max_overflow
+        status['timeout'] = pool._timeout
+    if isinstance(pool, InstrumentedQueuePool):
+        status.update(pool.stats.as_dict())
+    return status
+
+
+# set while replica reads are allowed, holds the sticky key (or True)
+_replica_reads = ContextVar('replica_reads', default=None)
+# set once a read of the current read-only call went to a replica
+_used_replica = ContextVar('used_replica', default=False)
+# key -> True while reads for it must stay on the primary
+_sticky = TTLCache(10000)
+_replica_down_until = {}
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        wrote = self._flushing or getattr(clause, 'is_dml', False)
+        if wrote:
+            self.info['wrote'] = True
+        elif _replica_reads.get() is not None and not self.info.get('wrote'):
+            engine = self._replica_engine()
+            if engine is not None:
+                _used_replica.set(True)
+                return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def _replica_engine(self):
+        sticky_key = _replica_reads.get()
+        if sticky_key is not True and _sticky.get(sticky_key):
+            return None
+        keys = _live_replica_keys(self.app)
+        if not keys:
+            return None
+        db = self.app.extensions['sqlalchemy'].db
+        return db.get_engine(self.app, bind=random.choice(keys))
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+@event.listens_for(RoutingSession, 'after_rollback')
+def _reset_wrote(session):
+    session.info.pop('wrote', None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def replica_keys(app):
+    return [key for key in app.config.get('SQLALCHEMY_BINDS') or {}
+            if key.startswith('replica')]
+
+
+def _live_replica_keys(app):
+    now = time.time()
+    return [key for key in replica_keys(app) if _replica_down_until.get(key, 0) <= now]
+
+
+def may_read_replica(app, key=None):
+    """True if a read-only read for ``key`` can go to a replica, which may
+    not have the latest writes of other workers yet
+
+    Stickiness (``mark_written``) is per process: it only covers the
+    writes of this worker.
+    """
+    if key is not None and _sticky.get(key):
+        return False
+    return bool(_live_replica_keys(app))
+
+
+def mark_written(app, key):
+    """Keep reads for ``key`` on the primary for the stickiness window"""
+    if key is not None:
+        _sticky.set(key, True, time.time() + app.config.get('REPLICA_STICKINESS_SECONDS', 0))
+
+
+def mark_replicas_down(app):
+    until = time.time() + app.config.get('REPLICA_RETRY_SECONDS', 30)
+    for key in replica_keys(app):
+        _replica_down_until[key] = until
+
+
+@contextmanager
+def replica_reads(sticky_key=None):
+    token = _replica_reads.set(True if sticky_key is None else sticky_key)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """Send the reads inside to the primary, also within ``replica_reads``"""
+    token = _replica_reads.set(None)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def reading_replicas():
+    return _replica_reads.get() is not None
+
+
+def run_read_only(db, fn, *args, sticky_key=None, **kwargs):
+    """Call ``fn`` with replica reads, again on the primary if a replica failed"""
+    used_token = _used_replica.set(False)
+    try:
+        with replica_reads(sticky_key):
+            return fn(*args, **kwargs)
+    except OperationalError:
+        if not _used_replica.get():
+            raise
+        db.session.rollback()
+        mark_replicas_down(db.get_app())
+        return fn(*args, **kwargs)
+    finally:
+        _used_replica.reset(used_token)
+
+
+def read_only(db, sticky_key=None):
+    """View decorator routing the view's reads to replicas
+
+    ``sticky_key`` is a callable returning the key (e.g. the JWT identity)
+    whose recent writes must be read from the primary.
+    """
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            key = sticky_key() if sticky_key else None
+            return run_read_only(db, fn, *args, sticky_key=key, **kwargs)
+        return decorator
+    return wrapper
@@ -0,0 +1,46 @@
+# Loaded automatically by gunicorn from the working directory.
+import glob
+import os
+import sys
+
+from prometheus_client import CollectorRegistry, multiprocess, start_http_server
+
+# a sync worker serves one request at a time, so it would just wait on the
+# password hashing pool (PASSWORD_HASH_WORKERS); with threads the other
+# requests of the worker go on meanwhile
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+
+def on_starting(server):
+    if os.environ.get('REVOCATION_BACKEND') == 'memory' and server.cfg.workers > 1:
+        # every worker would keep its own issued and revoked tokens
+        raise RuntimeError('REVOCATION_BACKEND=memory needs a single worker, got {}'
+                           .format(server.cfg.workers))
+    # samples of a previous run would be summed into the new one
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        os.makedirs(path, exist_ok=True)
+        for filename in glob.glob(os.path.join(path, '*.db')):
+            os.remove(filename)
+
+
+def when_ready(server):
+    # /metrics of all workers, on a port the ingress does not route to
+    port = int(os.environ.get('METRICS_PORT', 0))
+    if port and os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(port, registry=registry)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):
+    # write the tokens a write-behind worker still has queued
+    utils = sys.modules.get('api.v1.utils')
+    if utils is not None and utils.token_writer is not None:
+        utils.token_writer.close()
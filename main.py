@@ -1,11 +1,15 @@
 from flask import Flask, jsonify, make_response
 from config import DevConfig, ProductionConfig
-from flask_sqlalchemy import SQLAlchemy
-from flask_jwt_extended import JWTManager
+from database import RoutingSQLAlchemy
+from metrics import InstrumentedJWTManager, init_app as init_metrics
 from flask_migrate import Migrate
 from dotenv import load_dotenv
 from werkzeug.exceptions import HTTPException
+import gzip
+import json
 import os
+import sys
+import click
 import pytest
 
 load_dotenv('.env')
@@ -14,16 +18,22 @@ app = Flask(__name__)
 sconfig = os.environ.get('CONFIG_ENV')
 JWT_KEY = os.environ.get('SECRET_KEY')
 app.config.from_object(sconfig)
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
 migrate = Migrate(app, db)
 app.config["JWT_SECRET_KEY"] = JWT_KEY
-jwt = JWTManager(app)
+jwt = InstrumentedJWTManager(app)
+init_metrics(app)
 
 from models.users import User
 from models.roles import Role
 from models.tokens import Token
+from models.revocation_events import RevocationEvent
 
+from api.v1.keys import *
 from api.v1.accounts import *
+from api.v1.diagnostics import *
+from api.v1.introspection import *
+from api.v1.bulk import *
 
 version = "0.2.2"
 
@@ -103,4 +113,125 @@ def run_test():
 def seed_default_data():
    """Seed default roles & users"""
    Role.generate_default_roles()
-   User.generate_default_users()
\ No newline at end of file
+   User.generate_default_users()
+
+@app.cli.command('purge-expired-tokens')
+@click.option('--chunk-size', default=1000, show_default=True, help='Rows deleted per transaction')
+@click.option('--pause', default=0.1, show_default=True, help='Seconds to sleep between chunks')
+@click.option('--dry-run', is_flag=True, help='Only count the expired rows')
+def purge_tokens(chunk_size, pause, dry_run):
+    """Delete expired (including revoked) tokens and revocation events in chunks"""
+    from api.v1.utils import purge_expired_tokens
+
+    count = purge_expired_tokens(chunk_size=chunk_size, pause=pause, dry_run=dry_run)
+    events = purge_expired_tokens(chunk_size=chunk_size, pause=pause, dry_run=dry_run,
+                                  model=RevocationEvent)
+    if dry_run:
+        click.echo('{} expired tokens would be deleted'.format(count))
+        click.echo('{} expired revocation events would be deleted'.format(events))
+    else:
+        click.echo('{} expired tokens deleted'.format(count))
+        click.echo('{} expired revocation events deleted'.format(events))
+
+@app.cli.command('calibrate-password-hash')
+@click.option('--target-ms', default=250, show_default=True, help='Wanted time per hash')
+def calibrate_password_hash(target_ms):
+    """Suggest PASSWORD_HASH_ITERATIONS for this machine"""
+    from api.v1.hashing import calibrate, password_method
+
+    method = app.config['PASSWORD_HASH_METHOD']
+    if not method.startswith('pbkdf2:'):
+        raise click.UsageError('only pbkdf2 methods have a tunable cost')
+    result = calibrate(target_ms, method=method)
+    click.echo('current: {}'.format(password_method(app.config)))
+    click.echo('{} ms per 1000 iterations'.format(result['ms_per_1000_iterations']))
+    click.echo('PASSWORD_HASH_ITERATIONS={} for ~{} ms per hash'.format(
+        result['suggested_iterations'], target_ms))
+
+@app.cli.command('generate-signing-key')
+@click.option('--kid', required=True, help='Key id, also the file name in JWT_KEYS_DIR')
+@click.option('--algorithm', default=None, help='Defaults to JWT_ALGORITHM')
+def generate_signing_key(kid, algorithm):
+    """Create a new private key in JWT_KEYS_DIR for key rotation"""
+    from api.v1.keys import generate_key, write_key
+
+    keys_dir = app.config.get('JWT_KEYS_DIR')
+    if not keys_dir:
+        raise click.UsageError('JWT_KEYS_DIR is not set')
+    path = os.path.join(keys_dir, '{}.pem'.format(kid))
+    if os.path.exists(path):
+        raise click.UsageError('{} already exists'.format(path))
+    os.makedirs(keys_dir, exist_ok=True)
+    write_key(path, generate_key(algorithm or app.config['JWT_ALGORITHM']))
+    click.echo('written {}'.format(path))
+
+@app.cli.command('import-users')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default=None,
+              help='Defaults to the file extension')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per insert')
+@click.option('--workers', default=os.cpu_count(), show_default=True, help='Password hashing processes')
+@click.option('--rejects', 'rejects_path', default=None, help='NDJSON file for rejected rows [<path>.rejects]')
+def import_users_command(path, fmt, batch_size, workers, rejects_path):
+    """Import users from a CSV/NDJSON file"""
+    from api.v1.bulk import import_users, without_password
+
+    fmt = fmt or ('csv' if path.endswith('.csv') else 'ndjson')
+    rejects_path = rejects_path or path + '.rejects'
+    with open(path, newline='', encoding='utf-8') as stream, \
+            open(rejects_path, 'w', encoding='utf-8') as rejects:
+        def reject(line_number, row, error):
+            rejects.write(json.dumps({'line': line_number, 'row': without_password(row),
+                                      'error': error}) + '\n')
+
+        stats = import_users(stream, fmt=fmt, batch_size=batch_size, workers=workers, reject=reject)
+    click.echo('{} users imported, {} rejected'.format(stats['imported'], stats['rejected']))
+    if stats['rejected']:
+        click.echo('rejected rows written to {}'.format(rejects_path))
+
+@app.cli.command('export-users')
+@click.argument('output', default='-')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default='ndjson', show_default=True)
+@click.option('--after-id', default=0, show_default=True, help='Resume after this user id')
+@click.option('--gzip', 'compress', is_flag=True, help='gzip the output')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows fetched per round trip')
+def export_users_command(output, fmt, after_id, compress, batch_size):
+    """Stream users in id order to OUTPUT (default stdout)"""
+    from api.v1.bulk import export_users
+
+    if output == '-':
+        stream = sys.stdout.buffer
+        if compress:
+            stream = gzip.GzipFile(fileobj=stream, mode='wb')
+    else:
+        stream = gzip.open(output, 'wb') if compress else open(output, 'wb')
+    try:
+        for chunk in export_users(fmt, after_id, batch_size):
+            stream.write(chunk.encode('utf-8'))
+    finally:
+        if stream is not sys.stdout.buffer:
+            stream.close()
+        else:
+            stream.flush()
+
+@app.cli.command('generate-synthetic-data')
+@click.option('--users', 'user_count', default=10000, show_default=True)
+@click.option('--tokens', 'token_count', default=50000, show_default=True)
+@click.option('--expired-ratio', default=0.3, show_default=True)
+@click.option('--revoked-ratio', default=0.2, show_default=True, help='Share of the unexpired tokens')
+@click.option('--password', default='pass1234', show_default=True, help='Password of every generated user')
+@click.option('--batch-size', default=10000, show_default=True, help='Rows per INSERT')
+def generate_synthetic_data(user_count, token_count, expired_ratio, revoked_ratio, password, batch_size):
+    """Bulk insert synthetic users and tokens for benchmarks and query plans"""
+    import uuid
+    from functools import partial
+    from api.v1.hashing import hash_password
+
+    prefix = 'synthetic_' + uuid.uuid4().hex[:8]
+    User.generate_synthetic_users(user_count, hash_password(password), prefix=prefix, batch_size=batch_size)
+    click.echo('{} users inserted as {}_<n>'.format(user_count, prefix))
+    if token_count and user_count:
+        Token.generate_synthetic_tokens(token_count, user_count, partial(User.synthetic_uuid, prefix),
+                                        expired_ratio=expired_ratio, revoked_ratio=revoked_ratio,
+                                        batch_size=batch_size)
+        click.echo('{} tokens inserted'.format(token_count))
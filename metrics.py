@@ -0,0 +1,222 @@
+"""Prometheus metrics and request profiling
+
+Under gunicorn set PROMETHEUS_MULTIPROC_DIR to an empty directory: every
+worker then writes its samples to files there, and the gunicorn master
+aggregates all of them on METRICS_PORT (see gunicorn.conf.py, which also
+cleans up after dead workers). That port is not the app port the ingress
+exposes. With METRICS_PORT unset (flask run, tests) the app serves them at
+/metrics itself.
+
+With SQL_PROFILING on, every statement of a request is kept with its
+duration, requests slower than SLOW_REQUEST_MS (or running a statement
+slower than SLOW_QUERY_MS) are logged with their statements grouped by
+text, which makes N+1 patterns stand out, and responses get a
+``Server-Timing`` header splitting the time into db, hash, jwt and
+serialization.
+"""
+from collections import Counter as StatementCounter
+from contextlib import contextmanager
+import os
+import time
+
+from flask import Response, _request_ctx_stack, has_request_context, request
+from flask.json import JSONEncoder
+from flask_jwt_extended import JWTManager
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0)
+
+REQUEST_LATENCY = Histogram(
+    'sc_auth_request_duration_seconds', 'Request latency',
+    ['method', 'route', 'status'],
+)
+DB_QUERIES = Histogram(
+    'sc_auth_db_queries_per_request', 'SQL statements executed per request',
+    ['route'], buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 32),
+)
+DB_DURATION = Histogram(
+    'sc_auth_db_duration_seconds', 'Time spent in SQL per request',
+    ['route'], buckets=FAST_BUCKETS,
+)
+PASSWORD_HASH_DURATION = Histogram(
+    'sc_auth_password_hash_duration_seconds', 'Password hash/verify time',
+    ['operation'], buckets=(.01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0),
+)
+JWT_DURATION = Histogram(
+    'sc_auth_jwt_duration_seconds', 'JWT sign/verify time',
+    ['operation'], buckets=FAST_BUCKETS,
+)
+TOKEN_CACHE_LOOKUPS = Counter(
+    'sc_auth_token_cache_lookups_total', 'Blocklist cache lookups',
+    ['result'],
+)
+TOKEN_QUEUE_DEPTH = Gauge(
+    'sc_auth_token_write_queue_depth', 'Issued tokens waiting to be written',
+    multiprocess_mode='livesum',
+)
+TOKEN_QUEUE_FULL = Counter(
+    'sc_auth_token_write_queue_full_total', 'Token submits that found the write queue full',
+    ['action'],
+)
+TOKEN_FLUSH_DURATION = Histogram(
+    'sc_auth_token_flush_duration_seconds', 'Time to write one batch of queued tokens',
+    buckets=FAST_BUCKETS,
+)
+TOKEN_FLUSH_ROWS = Counter(
+    'sc_auth_token_flush_rows_total', 'Queued token rows written or dropped',
+    ['result'],
+)
+
+
+def request_timings():
+    """Per-request totals by category (db, hash, jwt, ...), None outside a request"""
+    if not has_request_context():
+        return None
+    ctx = _request_ctx_stack.top
+    if not hasattr(ctx, 'timings'):
+        ctx.timings = {'db': 0.0, 'db_queries': 0}
+    return ctx.timings
+
+
+def add_timing(category, seconds):
+    timings = request_timings()
+    if timings is not None:
+        timings[category] = timings.get(category, 0.0) + seconds
+
+
+@contextmanager
+def timed(category, histogram=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        add_timing(category, elapsed)
+        if histogram is not None:
+            histogram.observe(elapsed)
+
+
+class InstrumentedJWTManager(JWTManager):
+    """JWTManager timing every token sign and verify"""
+
+    def _encode_jwt_from_config(self, *args, **kwargs):
+        with timed('jwt', JWT_DURATION.labels('sign')):
+            return super(InstrumentedJWTManager, self)._encode_jwt_from_config(*args, **kwargs)
+
+    def _decode_jwt_from_config(self, *args, **kwargs):
+        with timed('jwt', JWT_DURATION.labels('verify')):
+            return super(InstrumentedJWTManager, self)._decode_jwt_from_config(*args, **kwargs)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # after_cursor_execute does not run for a failed statement
+    if context.connection is not None:
+        starts = context.connection.info.get('query_start')
+        if starts:
+            starts.pop()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    timings = request_timings()
+    if timings is not None:
+        timings['db'] += elapsed
+        timings['db_queries'] += 1
+        if 'statements' in timings:
+            timings['statements'].append((statement, elapsed))
+
+
+class TimedJSONEncoder(JSONEncoder):
+    """Counts response encoding as serialization time"""
+
+    def encode(self, o):
+        with timed('serialization'):
+            return super(TimedJSONEncoder, self).encode(o)
+
+
+def route_label():
+    # the rule, not the path, keeps the label cardinality bounded
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def server_timing(timings, total):
+    parts = ['db;dur={:.2f};desc="{} queries"'.format(timings['db'] * 1000, timings['db_queries'])]
+    for category in ('hash', 'jwt', 'serialization'):
+        if category in timings:
+            parts.append('{};dur={:.2f}'.format(category, timings[category] * 1000))
+    parts.append('total;dur={:.2f}'.format(total * 1000))
+    return ', '.join(parts)
+
+
+def log_slow_request(app, timings, total, route):
+    slow_query_ms = app.config.get('SLOW_QUERY_MS', 0)
+    slowest = max([elapsed for _, elapsed in timings['statements']] or [0])
+    if total * 1000 < app.config.get('SLOW_REQUEST_MS', 0) and slowest * 1000 < slow_query_ms:
+        return
+
+    counts = StatementCounter(statement for statement, _ in timings['statements'])
+    durations = {}
+    for statement, elapsed in timings['statements']:
+        durations[statement] = durations.get(statement, 0.0) + elapsed
+    lines = ['{} x{} {:.2f}ms: {}'.format('!' if count > 1 else ' ', count,
+                                        durations[statement] * 1000, ' '.join(statement.split()))
+             for statement, count in counts.most_common()]
+    app.logger.warning('slow request %s %s: %.2fms, %d queries in %.2fms\n%s',
+                       request.method, route, total * 1000, timings['db_queries'],
+                       timings['db'] * 1000, '\n'.join(lines))
+
+
+def init_app(app):
+    app.json_encoder = TimedJSONEncoder
+
+    @app.before_request
+    def start_timer():
+        timings = request_timings()
+        timings['start'] = time.perf_counter()
+        if app.config.get('SQL_PROFILING'):
+            timings['statements'] = []
+
+    @app.after_request
+    def record_request(response):
+        timings = request_timings()
+        if 'start' in timings:
+            total = time.perf_counter() - timings['start']
+            route = route_label()
+            REQUEST_LATENCY.labels(request.method, route, response.status_code).observe(total)
+            DB_QUERIES.labels(route).observe(timings['db_queries'])
+            DB_DURATION.labels(route).observe(timings['db'])
+            if 'statements' in timings:
+                response.headers['Server-Timing'] = server_timing(timings, total)
+                log_slow_request(app, timings, total, route)
+        return response
+
+    if app.config.get('METRICS_PORT'):
+        # served by the gunicorn master, off the public port
+        return
+
+    @app.route('/metrics')
+    def metrics():
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,16 @@
+from main import db
+from sqlalchemy.sql import func
+
+class RevocationEvent(db.Model):
+    """Append-only log of revocations, polled by every worker
+
+    ``jti`` is set for a single revoked token; a NULL jti means every token
+    of ``user_uuid`` was revoked (its tokens_valid_after moved).
+    """
+    __tablename__ = 'revocation_events'
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36))
+    user_uuid = db.Column(db.String(64), nullable=False)
+    # rows are purged with the tokens they revoke
+    expires = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
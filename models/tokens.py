@@ -1,3 +1,7 @@
+from datetime import datetime, timedelta
+import random
+import uuid
+
 from main import db
 
 class Token(db.Model):
@@ -7,7 +11,7 @@ class Token(db.Model):
     token_type = db.Column(db.String(10), nullable=False)
     user_uuid = db.Column(db.String(64), db.ForeignKey("users.uuid"), nullable=False)
     revoked = db.Column(db.Boolean, nullable=False)
-    expires = db.Column(db.DateTime, nullable=False)
+    expires = db.Column(db.DateTime, nullable=False, index=True)
 
     user = db.relationship("User", lazy="joined")
 
@@ -20,3 +24,27 @@ class Token(db.Model):
             "revoked": self.revoked,
             "expires": self.expires,
         }
+
+    @staticmethod
+    def generate_synthetic_tokens(count, user_count, user_uuid, expired_ratio=0.3, revoked_ratio=0.2,
+                                  batch_size=10000):
+        """Bulk insert ``count`` tokens owned by random ``user_uuid(0..user_count-1)``
+
+        ``expired_ratio`` of them expired up to 30 days ago, ``revoked_ratio``
+        of the rest revoked, the remainder active for up to 30 days.
+        """
+        now = datetime.now()
+        for start in range(0, count, batch_size):
+            rows = []
+            for _ in range(start, min(start + batch_size, count)):
+                expired = random.random() < expired_ratio
+                offset = timedelta(seconds=random.randint(1, 30 * 24 * 3600))
+                rows.append({
+                    'jti': str(uuid.uuid4()),
+                    'token_type': random.choice(('access', 'refresh')),
+                    'user_uuid': user_uuid(random.randrange(user_count)),
+                    'revoked': not expired and random.random() < revoked_ratio,
+                    'expires': now - offset if expired else now + offset,
+                })
+            db.session.execute(Token.__table__.insert(), rows)
+            db.session.commit()
@@ -15,11 +15,23 @@ class User(db.Model):
     role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
     created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
     updated_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    # bumped on every role change, tokens carrying an older value are re-checked
+    role_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # unix time with sub-second precision (a double on MySQL), tokens
+    # issued (iat_ms) before it are rejected
+    tokens_valid_after = db.Column(db.Float(precision=53), nullable=False, default=0, server_default='0')
     roles = db.relationship("Role", backref=db.backref("roles", uselist=False))
    
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
+    def set_role(self, role):
+        if self.role_id != role.id:
+            # role_id only: the uselist=False backref on Role would unset the
+            # role of the previous user sharing it if we assigned ``roles``
+            self.role_id = role.id
+            self.role_version = (self.role_version or 0) + 1
+
     @staticmethod
     def generate_default_users():
         admin_role = Role.query.filter_by(name='Admin').first().id
@@ -47,4 +59,28 @@ class User(db.Model):
         try:
             db.session.commit()
         except:
-            db.session.rollback()
\ No newline at end of file
+            db.session.rollback()
+
+    @staticmethod
+    def generate_synthetic_users(count, pwhash, prefix='synthetic', role_name='User', batch_size=10000):
+        """Bulk insert users ``<prefix>_0`` .. ``<prefix>_<count-1>`` sharing one password hash
+
+        The uuid of each row is derived from its username (see
+        ``synthetic_uuid``) so tokens can reference them without keeping
+        millions of them in memory.
+        """
+        role_id = Role.query.filter_by(name=role_name).first().id
+        for start in range(0, count, batch_size):
+            db.session.execute(User.__table__.insert(), [{
+                'uuid': User.synthetic_uuid(prefix, i),
+                'username': '{}_{}'.format(prefix, i),
+                'email': '{}_{}@email.com'.format(prefix, i),
+                'name': prefix,
+                'password': pwhash,
+                'role_id': role_id,
+            } for i in range(start, min(start + batch_size, count))])
+            db.session.commit()
+
+    @staticmethod
+    def synthetic_uuid(prefix, i):
+        return uuid.uuid5(uuid.NAMESPACE_OID, '{}_{}'.format(prefix, i)).hex
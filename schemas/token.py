@@ -0,0 +1,9 @@
+from marshmallow import Schema, fields, validate
+from main import app
+
+class TokenIntrospectSchema(Schema):
+    tokens = fields.List(
+        fields.Str(),
+        required=True,
+        validate=validate.Length(min=1, max=app.config['INTROSPECT_MAX_TOKENS'])
+    )
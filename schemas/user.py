@@ -26,4 +26,5 @@ class UsersResponse(Schema):
 class UserUpdateSchema(Schema):
     uuid = fields.Str(required=True)
     name = fields.Str()
-    password = fields.Str()
\ No newline at end of file
+    password = fields.Str()
+    role_name = fields.Str()
\ No newline at end of file
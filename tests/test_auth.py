@@ -427,4 +427,817 @@ def test_admin_update_user(client):
         headers=headers
     )
 
-    assert b'uniqueunix' in rv.data
\ No newline at end of file
+    assert b'uniqueunix' in rv.data
+
+def test_token_cache_stats(client):
+    payload = {
+        'username': 'adminok',
+        'password': 'admin33'
+    }
+    rv = login(client, json.dumps(payload))
+    access_token = json.loads(rv.data)['data']['access_token']
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + access_token
+    }
+
+    client.get('/api/v1/accounts/me', headers=headers)
+    rv = client.get('/api/v1/diagnostics/token-cache', headers=headers)
+    data = json.loads(rv.data)['data']
+    assert rv.status_code == 200
+    assert data['hits'] >= 1
+    assert 'misses' in data
+
+def test_denylist_mode(client):
+    from models.tokens import Token
+
+    app.config['TOKEN_STORAGE_MODE'] = 'denylist'
+    try:
+        tokens_before = Token.query.count()
+        payload = {
+            'username': 'test_user',
+            'password': 'pass1234',
+        }
+        rv = login(client, json.dumps(payload))
+        assert rv.status_code == 200
+        assert Token.query.count() == tokens_before
+
+        access_token = json.loads(rv.data)['data']['access_token']
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer ' + access_token
+        }
+        rv = profile(client, headers)
+        assert rv.status_code == 200
+
+        rv = logout(client, headers)
+        assert b'ok' in rv.data
+        assert Token.query.count() == tokens_before + 1
+
+        rv = profile(client, headers)
+        assert b'revoked' in rv.data
+        assert rv.status_code == 401
+    finally:
+        app.config['TOKEN_STORAGE_MODE'] = 'allowlist'
+
+def test_purge_expired_tokens(client):
+    from datetime import datetime, timedelta
+    from models.tokens import Token
+
+    user = User.query.filter_by(username='test_user').first()
+    for i in range(5):
+        db.session.add(Token(
+            jti=uuid.uuid4().hex,
+            token_type='access',
+            user_uuid=user.uuid,
+            revoked=bool(i % 2),
+            expires=datetime.now() - timedelta(hours=1),
+        ))
+    db.session.commit()
+    active = Token.query.filter(Token.expires >= datetime.now()).count()
+
+    runner = app.test_cli_runner()
+    rv = runner.invoke(args=['purge-expired-tokens', '--dry-run'])
+    assert '5 expired tokens would be deleted' in rv.output
+
+    rv = runner.invoke(args=['purge-expired-tokens', '--chunk-size', '2', '--pause', '0'])
+    assert '5 expired tokens deleted' in rv.output
+    assert Token.query.count() == active
+
+def test_admin_list_users_paginated(client):
+    payload = {
+        'username': 'adminok',
+        'password': 'admin33'
+    }
+    rv = login(client, json.dumps(payload))
+    access_token = json.loads(rv.data)['data']['access_token']
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + access_token
+    }
+    total = User.query.count()
+
+    seen = []
+    cursor = None
+    while True:
+        url = '/api/v1/users?limit=2' + ('&cursor=' + cursor if cursor else '')
+        rv = client.get(url, headers=headers)
+        body = json.loads(rv.data)
+        assert rv.status_code == 200
+        assert len(body['data']) <= 2
+        seen.extend(user['uuid'] for user in body['data'])
+        cursor = body['next']
+        if cursor is None:
+            break
+    assert len(seen) == total
+    assert len(set(seen)) == total
+
+    rv = client.get('/api/v1/users?stream=1', headers=headers)
+    body = json.loads(rv.data)
+    assert body['status'] == 'ok'
+    assert [user['uuid'] for user in body['data']] == seen
+
+    rv = client.get('/api/v1/users?limit=abc', headers=headers)
+    assert rv.status_code == 422
+
+def test_login_rehashes_outdated_password(client):
+    from werkzeug.security import check_password_hash
+    from api.v1.hashing import hashing_service
+
+    user = User.query.filter_by(username='test_user').first()
+    user.password = generate_password_hash('pass1234', method='pbkdf2:sha256:1000')
+    db.session.commit()
+    assert hashing_service.needs_rehash(user.password)
+
+    payload = {
+        'username': 'test_user',
+        'password': 'pass1234',
+    }
+    rv = login(client, json.dumps(payload))
+    assert rv.status_code == 200
+
+    db.session.expire_all()
+    user = User.query.filter_by(username='test_user').first()
+    assert not hashing_service.needs_rehash(user.password)
+    assert check_password_hash(user.password, 'pass1234')
+
+    runner = app.test_cli_runner()
+    rv = runner.invoke(args=['calibrate-password-hash', '--target-ms', '10'])
+    assert 'PASSWORD_HASH_ITERATIONS=' in rv.output
+
+def test_admin_role_from_claims(client):
+    from flask_jwt_extended import decode_token
+
+    payload = {
+        'username': 'adminok',
+        'password': 'admin33'
+    }
+    rv = login(client, json.dumps(payload))
+    admin_token = json.loads(rv.data)['data']['access_token']
+    admin_headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + admin_token
+    }
+    with app.app_context():
+        claims = decode_token(admin_token)
+    assert claims['role'] == 'Admin'
+
+    # promote a user, the old token claims 'User' but the version moved on
+    payload = {
+        'username': 'test_user',
+        'password': 'pass1234'
+    }
+    rv = login(client, json.dumps(payload))
+    user_token = json.loads(rv.data)['data']['access_token']
+    user_headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + user_token
+    }
+    rv = client.get('/api/v1/users', headers=user_headers)
+    assert rv.status_code == 403
+
+    user_uuid = User.query.filter_by(username='test_user').first().uuid
+    rv = client.patch(
+        '/api/v1/users',
+        data=json.dumps({'uuid': user_uuid, 'role_name': 'Admin'}),
+        headers=admin_headers
+    )
+    assert rv.status_code == 200
+    rv = client.get('/api/v1/users', headers=user_headers)
+    assert rv.status_code == 200
+
+    # and demote again
+    rv = client.patch(
+        '/api/v1/users',
+        data=json.dumps({'uuid': user_uuid, 'role_name': 'User'}),
+        headers=admin_headers
+    )
+    assert rv.status_code == 200
+    rv = client.get('/api/v1/users', headers=user_headers)
+    assert rv.status_code == 403
+
+    rv = client.patch(
+        '/api/v1/users',
+        data=json.dumps({'uuid': user_uuid, 'role_name': 'nope'}),
+        headers=admin_headers
+    )
+    assert rv.status_code == 422
+
+def test_set_role_shared_role(client):
+    admin_role = Role.query.filter_by(name='Admin').first()
+    user_role = Role.query.filter_by(name='User').first()
+    admin = User.query.filter_by(username='adminok').first()
+    user = User.query.filter_by(username='test_user').first()
+    # load both sides of the uselist=False backref
+    assert admin.roles is admin_role
+    assert admin_role.roles is not None
+
+    user.set_role(admin_role)
+    db.session.commit()
+    db.session.expire_all()
+    assert User.query.filter_by(username='adminok').first().role_id == admin_role.id
+    assert User.query.filter_by(username='test_user').first().role_id == admin_role.id
+
+    user = User.query.filter_by(username='test_user').first()
+    user.set_role(user_role)
+    db.session.commit()
+    assert User.query.filter_by(username='adminok').first().role_id == admin_role.id
+
+def test_protected_endpoints_query_count(client):
+    from sqlalchemy import event
+
+    payload = {
+        'username': 'adminok',
+        'password': 'admin33'
+    }
+    rv = login(client, json.dumps(payload))
+    access_token = json.loads(rv.data)['data']['access_token']
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + access_token
+    }
+    # warm the token and role caches
+    client.get('/api/v1/users?limit=1', headers=headers)
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        rv = profile(client, headers)
+        assert rv.status_code == 200
+        # the user and its role in one statement, nothing else
+        assert len(statements) == 1
+
+        del statements[:]
+        rv = client.get('/api/v1/users?limit=1', headers=headers)
+        assert rv.status_code == 200
+        # only the page itself
+        assert len(statements) == 1
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+def test_jwks_endpoint(client):
+    rv = client.get('/.well-known/jwks.json')
+    assert rv.status_code == 200
+    assert 'keys' in json.loads(rv.data)
+    assert 'max-age' in rv.headers['Cache-Control']
+
+    rv = client.get('/.well-known/jwks.json', headers={'If-None-Match': rv.headers['ETag']})
+    assert rv.status_code == 304
+
+def test_introspect_tokens(client):
+    payload = {
+        'username': 'adminok',
+        'password': 'admin33'
+    }
+    rv = login(client, json.dumps(payload))
+    admin_tokens = json.loads(rv.data)['data']
+    admin_headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + admin_tokens['access_token']
+    }
+
+    payload = {
+        'username': 'test_user',
+        'password': 'pass1234'
+    }
+    rv = login(client, json.dumps(payload))
+    user_tokens = json.loads(rv.data)['data']
+    user_headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + user_tokens['access_token']
+    }
+    logout(client, user_headers)
+
+    payload = {
+        'tokens': [
+            admin_tokens['access_token'],
+            user_tokens['access_token'],
+            user_tokens['refresh_token'],
+            'not-a-token',
+        ]
+    }
+    rv = client.post('/api/v1/tokens/introspect', data=json.dumps(payload), headers=admin_headers)
+    assert rv.status_code == 200
+    results = json.loads(rv.data)['data']
+    assert results[0]['active'] is True
+    assert results[0]['type'] == 'access'
+    assert results[1] == {'active': False}
+    assert results[2]['active'] is True
+    assert results[2]['type'] == 'refresh'
+    assert results[3] == {'active': False}
+
+    rv = client.post('/api/v1/tokens/introspect', data=json.dumps({'tokens': []}), headers=admin_headers)
+    assert rv.status_code == 422
+
+    rv = client.post('/api/v1/tokens/introspect', data=json.dumps(payload), headers=user_headers)
+    assert rv.status_code == 401
+
+    # the watermarks of distinct users are read with a single query
+    from sqlalchemy import event
+    import api.v1.utils as utils
+
+    other = json.loads(login(client, json.dumps({'username': 'test_register_user',
+                                                 'password': 'pass1234'})).data)['data']
+    payload = {'tokens': [admin_tokens['access_token'], user_tokens['refresh_token'],
+                          other['access_token']]}
+    utils.watermark_cache.clear()
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        rv = client.post('/api/v1/tokens/introspect', data=json.dumps(payload), headers=admin_headers)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    assert [result['active'] for result in json.loads(rv.data)['data']] == [True, True, True]
+    watermark_queries = [statement for statement in statements if 'tokens_valid_after' in statement]
+    # the caller's own token, then one for the users of the three tokens
+    assert len(watermark_queries) == 2
+    assert 'IN' in watermark_queries[1]
+
+def test_token_cache_ttl_cap(client, monkeypatch):
+    import time
+    from models.tokens import Token
+    import api.v1.utils as utils
+
+    monkeypatch.setitem(app.config, 'TOKEN_CACHE_TTL', 5)
+    token = Token.query.filter_by(revoked=False).first()
+    jwt_payload = {'jti': token.jti, 'exp': time.time() + 3600}
+    for check in (utils.is_token_revoked, lambda payload: utils.revoked_jtis([payload])):
+        utils.token_cache.invalidate(token.jti)
+        check(jwt_payload)
+        # the single and the batch path cap the non-revoked entry alike
+        assert utils.token_cache._data[token.jti][1] <= time.time() + 5
+
+    # a non-revoked answer that may come from a lagging replica is not cached
+    monkeypatch.setitem(app.config, 'TOKEN_CACHE_TTL', 0)
+    monkeypatch.setattr(utils.revocation_backend, 'may_be_stale', lambda user=None: True)
+    utils.token_cache.invalidate(token.jti)
+    assert utils.is_token_revoked(jwt_payload) is False
+    assert utils.token_cache.get(token.jti) is None
+
+def test_admin_import_users(client, tmp_path):
+    payload = {
+        'username': 'adminok',
+        'password': 'admin33'
+    }
+    rv = login(client, json.dumps(payload))
+    access_token = json.loads(rv.data)['data']['access_token']
+
+    rows = [
+        {'username': 'import_1', 'password': 'pass1234', 'email': 'import_1@email.com',
+         'name': 'import', 'role_name': 'User'},
+        {'username': 'import_2', 'password': 'pass1234', 'email': 'import_2@email.com',
+         'name': 'import', 'role_name': 'nope'},
+        {'username': 'import_3', 'password': 'pass1234', 'email': 'import_1@email.com',
+         'name': 'import', 'role_name': 'User'},
+        {'username': 'i', 'password': 'pass1234', 'email': 'import_4@email.com',
+         'name': 'import', 'role_name': 'User'},
+    ]
+    body = '\n'.join(json.dumps(row) for row in rows) + '\n{broken\n'
+    rv = client.post(
+        '/api/v1/users/import',
+        data=body,
+        headers={
+            'Content-Type': 'application/x-ndjson',
+            'Authorization': 'Bearer ' + access_token
+        }
+    )
+    data = json.loads(rv.data)['data']
+    assert rv.status_code == 200
+    assert data['imported'] == 1
+    assert data['rejected'] == 4
+    assert [reject['line'] for reject in data['rejects']] == [2, 4, 5, 3]
+    assert 'password' not in data['rejects'][0]['row']
+
+    rv = login(client, json.dumps({'username': 'import_1', 'password': 'pass1234'}))
+    assert rv.status_code == 200
+
+    csv_path = tmp_path / 'users.csv'
+    csv_path.write_text(
+        'username,password,email,name,role_name\n'
+        'import_csv_1,pass1234,import_csv_1@email.com,import,User\n'
+        'import_csv_2,pass1234,import_csv_2@email.com,import,Admin\n'
+        'import_1,pass1234,import_csv_3@email.com,import,User\n'
+    )
+    runner = app.test_cli_runner()
+    rv = runner.invoke(args=['import-users', str(csv_path), '--workers', '2', '--batch-size', '2'])
+    assert '2 users imported, 1 rejected' in rv.output
+    rejects = (tmp_path / 'users.csv.rejects').read_text().splitlines()
+    assert json.loads(rejects[0])['line'] == 4
+
+def test_admin_import_users_lengths_and_cap(client, monkeypatch):
+    rv = login(client, json.dumps({'username': 'adminok', 'password': 'admin33'}))
+    access_token = json.loads(rv.data)['data']['access_token']
+    monkeypatch.setitem(app.config, 'BULK_IMPORT_MAX_ROWS', 2)
+
+    rows = [
+        {'username': 'u' * 65, 'password': 'pass1234', 'email': 'import_long@email.com',
+         'name': 'import', 'role_name': 'User'},
+        {'username': 'import_capped_1', 'password': 'pass1234', 'email': 'import_capped_1@email.com',
+         'name': 'import', 'role_name': 'User'},
+        {'username': 'import_capped_2', 'password': 'pass1234', 'email': 'import_capped_2@email.com',
+         'name': 'import', 'role_name': 'User'},
+    ]
+    rv = client.post(
+        '/api/v1/users/import',
+        data='\n'.join(json.dumps(row) for row in rows),
+        headers={
+            'Content-Type': 'application/x-ndjson',
+            'Authorization': 'Bearer ' + access_token
+        }
+    )
+    data = json.loads(rv.data)['data']
+    assert rv.status_code == 200
+    assert (data['imported'], data['rejected'], data['next_line']) == (1, 1, 3)
+    assert 'username' in data['rejects'][0]['error']
+    assert User.query.filter_by(username='import_capped_2').first() is None
+
+def test_admin_export_users(client, tmp_path):
+    import gzip
+
+    payload = {
+        'username': 'adminok',
+        'password': 'admin33'
+    }
+    rv = login(client, json.dumps(payload))
+    headers = {
+        'Authorization': 'Bearer ' + json.loads(rv.data)['data']['access_token']
+    }
+    total = User.query.count()
+
+    rv = client.get('/api/v1/users/export', headers=headers)
+    rows = [json.loads(line) for line in rv.data.decode().splitlines()]
+    assert rv.status_code == 200
+    assert len(rows) == total
+    assert 'password' not in rows[0]
+
+    rv = client.get('/api/v1/users/export?after={}'.format(rows[1]['id']), headers=headers)
+    assert len(rv.data.decode().splitlines()) == total - 2
+
+    rv = client.get('/api/v1/users/export?format=csv&gzip=1', headers=headers)
+    lines = gzip.decompress(rv.data).decode().splitlines()
+    assert lines[0] == 'id,uuid,username,email,name,role_id'
+    assert len(lines) == total + 1
+
+    output = tmp_path / 'users.ndjson.gz'
+    runner = app.test_cli_runner()
+    runner.invoke(args=['export-users', str(output), '--gzip', '--after-id', str(rows[0]['id'])])
+    assert len(gzip.decompress(output.read_bytes()).decode().splitlines()) == total - 1
+
+def test_pool_diagnostics(client):
+    payload = {
+        'username': 'adminok',
+        'password': 'admin33'
+    }
+    rv = login(client, json.dumps(payload))
+    headers = {
+        'Authorization': 'Bearer ' + json.loads(rv.data)['data']['access_token']
+    }
+    rv = client.get('/api/v1/diagnostics/pool', headers=headers)
+    assert rv.status_code == 200
+    assert 'class' in json.loads(rv.data)['data']
+
+def test_metrics_endpoint(client):
+    payload = {
+        'username': 'test_user',
+        'password': 'pass1234'
+    }
+    rv = login(client, json.dumps(payload))
+    headers = {
+        'Authorization': 'Bearer ' + json.loads(rv.data)['data']['access_token']
+    }
+    profile(client, headers)
+
+    rv = client.get('/metrics')
+    body = rv.data.decode()
+    assert rv.status_code == 200
+    assert 'sc_auth_request_duration_seconds_bucket{' in body
+    assert 'route="/api/v1/accounts/me"' in body
+    assert 'sc_auth_password_hash_duration_seconds_count{operation="verify"}' in body
+    assert 'sc_auth_jwt_duration_seconds_count{operation="sign"}' in body
+    assert 'sc_auth_db_queries_per_request_bucket{' in body
+    assert 'sc_auth_token_cache_lookups_total{result="hit"}' in body
+
+def test_metrics_port_and_failed_statements(client):
+    from flask import Flask
+    from sqlalchemy.exc import OperationalError
+    from metrics import init_app
+
+    # with METRICS_PORT the app port does not serve them
+    metrics_app = Flask('metrics')
+    metrics_app.config['METRICS_PORT'] = 9100
+    init_app(metrics_app)
+    assert '/metrics' not in [rule.rule for rule in metrics_app.url_map.iter_rules()]
+
+    with db.engine.connect() as connection:
+        with pytest.raises(OperationalError):
+            connection.execute('SELECT * FROM no_such_table')
+        assert connection.info.get('query_start') == []
+
+def test_sql_profiling(client, caplog):
+    payload = {
+        'username': 'test_user',
+        'password': 'pass1234'
+    }
+    rv = login(client, json.dumps(payload))
+    headers = {
+        'Authorization': 'Bearer ' + json.loads(rv.data)['data']['access_token']
+    }
+
+    rv = profile(client, headers)
+    assert 'Server-Timing' not in rv.headers
+
+    app.config['SQL_PROFILING'] = True
+    app.config['SLOW_REQUEST_MS'] = 0
+    try:
+        rv = profile(client, headers)
+        timing = rv.headers['Server-Timing']
+        assert timing.startswith('db;dur=')
+        assert 'jwt;dur=' in timing
+        assert 'serialization;dur=' in timing
+        assert 'slow request GET /api/v1/accounts/me' in caplog.text
+        assert 'FROM users' in caplog.text
+    finally:
+        app.config['SQL_PROFILING'] = False
+        app.config['SLOW_REQUEST_MS'] = 500
+
+def test_generate_synthetic_data(client):
+    from datetime import datetime
+    from models.tokens import Token
+
+    token_count = Token.query.count()
+    runner = app.test_cli_runner()
+    rv = runner.invoke(args=['generate-synthetic-data', '--users', '5', '--tokens', '40',
+                             '--expired-ratio', '0.5', '--revoked-ratio', '0.5', '--batch-size', '3'])
+    assert rv.exit_code == 0
+    prefix = rv.output.split(' as ')[1].split('_<n>')[0]
+
+    users = User.query.filter(User.username.like(prefix + '_%')).all()
+    assert len(users) == 5
+    assert len({user.password for user in users}) == 1
+    tokens = Token.query.filter(Token.user_uuid.in_([user.uuid for user in users])).all()
+    assert len(tokens) == 40
+    assert Token.query.count() == token_count + 40
+    assert any(token.expires < datetime.now() for token in tokens)
+    assert any(token.revoked for token in tokens)
+
+    payload = {'username': prefix + '_3', 'password': 'pass1234'}
+    rv = login(client, json.dumps(payload))
+    assert rv.status_code == 200
+
+def test_revoke_all_tokens(client):
+    payload = {
+        'username': 'revoke_all_user',
+        'password': 'pass1234',
+        'email': 'revoke_all_user@email.com',
+        'name': 'revoke_all_user'
+    }
+    register(client, json.dumps(payload))
+    credentials = json.dumps({'username': 'revoke_all_user', 'password': 'pass1234'})
+    sessions = [json.loads(login(client, credentials).data)['data'] for _ in range(2)]
+    access = [{'Authorization': 'Bearer ' + session['access_token']} for session in sessions]
+    assert profile(client, access[1]).status_code == 200
+
+    rv = client.delete('/api/v1/accounts/logout-all', headers=access[0])
+    assert rv.status_code == 200
+    for headers_user in access:
+        rv = profile(client, headers_user)
+        assert rv.status_code == 401
+        assert b'The token has revoked' in rv.data
+    rv = refresh_token(client, {'Authorization': 'Bearer ' + sessions[1]['refresh_token']})
+    assert rv.status_code == 401
+
+    # logging in again right away, within the same second, works
+    session = json.loads(login(client, credentials).data)['data']
+    assert profile(client, {'Authorization': 'Bearer ' + session['access_token']}).status_code == 200
+    rv = refresh_token(client, {'Authorization': 'Bearer ' + session['refresh_token']})
+    assert rv.status_code == 200
+
+    rv = login(client, json.dumps({'username': 'adminok', 'password': 'admin33'}))
+    headers_admin = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + json.loads(rv.data)['data']['access_token']
+    }
+    user = User.query.filter_by(username='revoke_all_user').first()
+    rv = client.post('/api/v1/users/revoke-all', data=json.dumps({'uuid': user.uuid}), headers=headers_admin)
+    assert rv.status_code == 200
+    rv = client.post('/api/v1/users/revoke-all', data=json.dumps({'uuid': 'nope'}), headers=headers_admin)
+    assert rv.status_code == 404
+    rv = client.post('/api/v1/users/revoke-all', data=json.dumps({}), headers=headers_admin)
+    assert rv.status_code == 422
+
+def test_shared_revocation_set(client, tmp_path, monkeypatch):
+    from flask_jwt_extended import decode_token
+    import api.v1.utils as utils
+    from api.v1.shm import SharedRevocationSet
+
+    monkeypatch.setattr(utils, 'shared_revocations', SharedRevocationSet(str(tmp_path / 'revocations'), slots=64))
+    credentials = json.dumps({'username': 'test_user', 'password': 'pass1234'})
+    tokens = [json.loads(login(client, credentials).data)['data']['access_token'] for _ in range(2)]
+    with app.app_context():
+        payloads = [decode_token(token) for token in tokens]
+    headers_user = {'Authorization': 'Bearer ' + tokens[0]}
+    assert profile(client, headers_user).status_code == 200
+
+    # a logout in this worker is published for the others
+    assert logout(client, headers_user).status_code == 200
+    assert utils.shared_revocations.contains(payloads[0]['jti'])
+
+    # a logout by another worker wins over this worker's cached "valid"
+    headers_user = {'Authorization': 'Bearer ' + tokens[1]}
+    assert profile(client, headers_user).status_code == 200
+    SharedRevocationSet(str(tmp_path / 'revocations'), slots=64).add(payloads[1]['jti'], payloads[1]['exp'])
+    assert profile(client, headers_user).status_code == 401
+
+def test_revocation_log_sync(client, monkeypatch):
+    import time
+    from flask_jwt_extended import decode_token
+    import api.v1.utils as utils
+    from api.v1.revocation_log import RevocationLog
+
+    revoked_users = []
+    # stands in for a worker of another replica
+    other = RevocationLog(interval=0.05, on_revoke_all=revoked_users.append)
+    monkeypatch.setitem(app.config, 'REVOCATION_SYNC_INTERVAL', 60)
+    monkeypatch.setattr(utils, 'revocation_log', RevocationLog(interval=60))
+    utils.revocation_log.warm()
+    other.start()
+    try:
+        credentials = json.dumps({'username': 'test_user', 'password': 'pass1234'})
+        token = json.loads(login(client, credentials).data)['data']['access_token']
+        with app.app_context():
+            jti = decode_token(token)['jti']
+        headers_user = {'Authorization': 'Bearer ' + token}
+        assert profile(client, headers_user).status_code == 200
+        assert logout(client, headers_user).status_code == 200
+        assert utils.revocation_log.contains(jti)
+
+        user = User.query.filter_by(username='revoke_all_user').first()
+        utils.revoke_all_tokens(user.uuid)
+        deadline = time.time() + 5
+        while not (other.contains(jti) and revoked_users) and time.time() < deadline:
+            time.sleep(0.05)
+        assert other.contains(jti)
+        assert revoked_users == [user.uuid]
+        assert other.fresh()
+    finally:
+        other.stop()
+
+def test_no_revocation_events_without_sync(client):
+    from models.revocation_events import RevocationEvent
+    import api.v1.utils as utils
+
+    assert not app.config['REVOCATION_SYNC_INTERVAL']
+    events = RevocationEvent.query.count()
+    credentials = json.dumps({'username': 'test_user', 'password': 'pass1234'})
+    token = json.loads(login(client, credentials).data)['data']['access_token']
+    assert logout(client, {'Authorization': 'Bearer ' + token}).status_code == 200
+    utils.revoke_all_tokens(User.query.filter_by(username='revoke_all_user').first().uuid)
+    # nothing would ever read them
+    assert RevocationEvent.query.count() == events
+
+def test_token_write_behind(client, monkeypatch):
+    from models.tokens import Token
+    import api.v1.utils as utils
+    from api.v1.write_behind import TokenWriter
+
+    writer = TokenWriter(utils._write_token_records, batch_size=100, interval=60)
+    monkeypatch.setattr(utils, 'token_writer', writer)
+    monkeypatch.setattr(utils.revocation_backend, 'writer', writer)
+    try:
+        tokens_before = Token.query.count()
+        credentials = json.dumps({'username': 'test_user', 'password': 'pass1234'})
+        rv = login(client, credentials)
+        assert rv.status_code == 200
+        assert len(writer) == 2
+        assert Token.query.count() == tokens_before
+
+        # queued, still valid in this worker
+        headers_user = {'Authorization': 'Bearer ' + json.loads(rv.data)['data']['access_token']}
+        assert profile(client, headers_user).status_code == 200
+
+        # the revoke writes the queue first
+        assert logout(client, headers_user).status_code == 200
+        assert len(writer) == 0
+        assert Token.query.count() == tokens_before + 2
+        assert profile(client, headers_user).status_code == 401
+    finally:
+        writer.close()
+
+def test_token_write_behind_thread(client):
+    import time
+    from datetime import datetime, timedelta
+    from models.tokens import Token
+    import api.v1.utils as utils
+    from api.v1.write_behind import TokenWriter
+
+    # the flush thread writes through the real insert, outside any request
+    writer = TokenWriter(utils._write_token_records, batch_size=100, interval=0.05,
+                         on_written=utils._mark_users_written, logger=app.logger)
+    user_uuid = User.query.filter_by(username='test_user').first().uuid
+    record = {
+        'jti': str(uuid.uuid4()),
+        'token_type': 'access',
+        'user_uuid': user_uuid,
+        'expires': datetime.now().replace(microsecond=0) + timedelta(hours=1),
+        'revoked': False,
+    }
+    try:
+        writer.submit([record])
+        deadline = time.time() + 5
+        while writer.is_pending(record['jti']) and time.time() < deadline:
+            time.sleep(0.01)
+        assert not writer.is_pending(record['jti'])
+        db.session.remove()
+        token = Token.query.filter_by(jti=record['jti']).one()
+        assert token.user_uuid == user_uuid and token.revoked is False
+    finally:
+        writer.close()
+
+def test_hot_queries(client):
+    from sqlalchemy import event
+    from models.tokens import Token
+    from api.v1 import queries
+
+    tokens = Token.query.order_by(Token.id).limit(2).all()
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        # the cached statements must not keep the values of the first call
+        for token in tokens:
+            assert queries.token_revoked(token.jti) is token.revoked
+        assert queries.token_revoked('missing') is None
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    assert not any('users' in statement for statement in statements)
+
+    user = User.query.filter_by(username='test_user').first()
+    assert queries.user_by_username('test_user') is user
+    assert queries.user_by_uuid(user.uuid).roles.name == 'User'
+    assert queries.user_by_uuid('missing') is None
+    assert queries.role_version(user.uuid) == user.role_version
+    assert queries.tokens_valid_after(user.uuid) == user.tokens_valid_after
+
+def test_deleted_user_tokens_rejected(client):
+    payload = {
+        'username': 'deleted_login',
+        'password': 'pass1234',
+        'email': 'deleted_login@email.com',
+        'name': 'deleted_login'
+    }
+    assert register(client, json.dumps(payload)).status_code == 201
+    rv = login(client, json.dumps({'username': 'deleted_login', 'password': 'pass1234'}))
+    user_token = json.loads(rv.data)['data']['access_token']
+    user_headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + user_token}
+    rv = login(client, json.dumps({'username': 'adminok', 'password': 'admin33'}))
+    admin_headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + json.loads(rv.data)['data']['access_token']
+    }
+    rv = client.post('/api/v1/tokens/introspect', data=json.dumps({'tokens': [user_token]}),
+                     headers=admin_headers)
+    assert json.loads(rv.data)['data'][0]['active'] is True
+
+    user_uuid = User.query.filter_by(username='deleted_login').first().uuid
+    rv = client.delete('/api/v1/users', data=json.dumps({'uuid': user_uuid}), headers=admin_headers)
+    assert rv.status_code == 200
+
+    # endpoints that never load the user reject the token too
+    assert logout(client, user_headers).status_code == 401
+    assert client.delete('/api/v1/accounts/logout-all', headers=user_headers).status_code == 401
+    rv = client.post('/api/v1/tokens/introspect', data=json.dumps({'tokens': [user_token]}),
+                     headers=admin_headers)
+    assert json.loads(rv.data)['data'][0] == {'active': False}
+
+def test_me_user_missing_on_replica(client, tmp_path, monkeypatch):
+    import database
+
+    payload = {
+        'username': 'test_user',
+        'password': 'pass1234'
+    }
+    rv = login(client, json.dumps(payload))
+    headers = {
+        'Authorization': 'Bearer ' + json.loads(rv.data)['data']['access_token']
+    }
+
+    # a replica that has not caught up with the user yet
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_BINDS',
+                        {'replica_0': 'sqlite:///' + str(tmp_path / 'replica.db')})
+    db.Model.metadata.create_all(db.get_engine(app, bind='replica_0'))
+    monkeypatch.setattr(database, '_sticky', database.TTLCache(10))
+
+    rv = profile(client, headers)
+    assert rv.status_code == 200
+    assert json.loads(rv.data)['data']['username'] == 'test_user'
@@ -0,0 +1,44 @@
+import time
+
+from api.v1.cache import TTLCache
+
+
+def test_cache_hit_and_miss():
+    cache = TTLCache(maxsize=10)
+    assert cache.get('a') is None
+    cache.set('a', False, time.time() + 60)
+    assert cache.get('a') is False
+
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+
+def test_cache_expires_at_exp():
+    cache = TTLCache(maxsize=10)
+    cache.set('a', False, time.time() + 0.05)
+    time.sleep(0.1)
+    assert cache.get('a') is None
+    cache.set('b', False, time.time() - 1)
+    assert cache.get('b') is None
+
+
+def test_cache_lru_eviction_and_invalidate():
+    cache = TTLCache(maxsize=2)
+    exp = time.time() + 60
+    cache.set('a', False, exp)
+    cache.set('b', False, exp)
+    cache.get('a')
+    cache.set('c', False, exp)
+    assert cache.get('b') is None
+    assert cache.get('a') is False
+
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_cache_disabled():
+    cache = TTLCache(maxsize=0)
+    cache.set('a', False, time.time() + 60)
+    assert cache.get('a') is None
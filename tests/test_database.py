@@ -0,0 +1,83 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError
+
+from database import InstrumentedQueuePool, pool_status
+
+
+def test_instrumented_pool_records_waits_and_timeouts():
+    engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool,
+                           pool_size=1, max_overflow=0, pool_timeout=0.05)
+    conn = engine.connect()
+    status = pool_status(engine)
+    assert status['checkedout'] == 1
+    assert status['checkouts'] == 1
+
+    with pytest.raises(TimeoutError):
+        engine.connect()
+    status = pool_status(engine)
+    assert status['timeouts'] == 1
+    assert status['wait_max_ms'] >= 50
+
+    conn.close()
+    assert pool_status(engine)['checkedin'] == 1
+
+
+def test_replica_routing(tmp_path):
+    from flask import Flask
+    from database import (
+        RoutingSQLAlchemy, mark_written, may_read_replica, replica_reads, run_read_only,
+        _replica_down_until
+    )
+
+    routing_app = Flask('routing')
+    routing_app.config.update(
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + str(tmp_path / 'primary.db'),
+        SQLALCHEMY_BINDS={'replica_0': 'sqlite:///' + str(tmp_path / 'replica.db')},
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        REPLICA_STICKINESS_SECONDS=60,
+    )
+    routing_db = RoutingSQLAlchemy(routing_app)
+
+    class Item(routing_db.Model):
+        id = routing_db.Column(routing_db.Integer, primary_key=True)
+        name = routing_db.Column(routing_db.String(20))
+
+    with routing_app.app_context():
+        replica = routing_db.get_engine(routing_app, bind='replica_0')
+        routing_db.create_all()
+        Item.__table__.create(replica)
+        replica.execute(Item.__table__.insert(), {'id': 1, 'name': 'replica'})
+
+        routing_db.session.add(Item(id=1, name='primary'))
+        routing_db.session.commit()
+        routing_db.session.remove()
+
+        def name():
+            return routing_db.session.query(Item.name).filter_by(id=1).scalar()
+
+        assert name() == 'primary'
+        routing_db.session.remove()
+        with replica_reads():
+            assert name() == 'replica'
+        routing_db.session.remove()
+
+        # read-your-writes for a key written recently
+        mark_written(routing_app, 'user-1')
+        assert not may_read_replica(routing_app, 'user-1')
+        assert may_read_replica(routing_app, 'user-2')
+        assert run_read_only(routing_db, name, sticky_key='user-1') == 'primary'
+        routing_db.session.remove()
+        assert run_read_only(routing_db, name, sticky_key='user-2') == 'replica'
+        routing_db.session.remove()
+
+        # a broken replica falls back to the primary and is skipped afterwards
+        Item.__table__.drop(replica)
+        assert run_read_only(routing_db, name) == 'primary'
+        assert _replica_down_until['replica_0'] > 0
+        assert not may_read_replica(routing_app, 'user-2')
+        routing_db.session.remove()
+        with replica_reads():
+            assert name() == 'primary'
+        _replica_down_until.clear()
+        routing_db.session.remove()
@@ -0,0 +1,42 @@
+import pytest
+
+from api.v1.hashing import HashingService, HashingUnavailable
+
+
+def test_hash_inline():
+    service = HashingService()
+    pwhash = service.hash('pass1234')
+    assert service.verify(pwhash, 'pass1234')
+    assert not service.verify(pwhash, 'pass12345')
+
+
+def test_hash_in_pool():
+    service = HashingService(workers=1, queue_size=1, timeout=30)
+    try:
+        pwhash = service.hash('pass1234')
+        assert service.verify(pwhash, 'pass1234')
+    finally:
+        service.shutdown()
+
+
+def test_hash_fails_fast_when_saturated():
+    service = HashingService(workers=1, queue_size=0, timeout=0.01)
+    try:
+        with pytest.raises(HashingUnavailable):
+            service.hash('pass1234', method='pbkdf2:sha256:2000000')
+        # the timed out hash still holds the only slot
+        with pytest.raises(HashingUnavailable):
+            service.hash('pass1234')
+    finally:
+        service.shutdown()
+
+
+def test_needs_rehash():
+    service = HashingService(method='pbkdf2:sha256:1000')
+    assert not service.needs_rehash(service.hash('pass1234'))
+    assert service.needs_rehash(service.hash('pass1234', method='pbkdf2:sha256:2000'))
+
+    # no iteration count (PASSWORD_HASH_ITERATIONS=0): werkzeug's default
+    service = HashingService(method='pbkdf2:sha256')
+    assert not service.needs_rehash(service.hash('pass1234'))
+    assert service.needs_rehash(service.hash('pass1234', method='pbkdf2:sha256:1000'))
@@ -0,0 +1,58 @@
+import jwt
+import pytest
+
+from api.v1.keys import KeyRing, generate_key, write_key
+
+
+@pytest.mark.parametrize('algorithm', ['RS256', 'ES256', 'EdDSA'])
+def test_keyring_sign_and_verify(tmp_path, algorithm):
+    write_key(str(tmp_path / 'k1.pem'), generate_key(algorithm))
+    write_key(str(tmp_path / 'k2.pem'), generate_key(algorithm))
+    keyring = KeyRing(str(tmp_path), algorithm=algorithm, active_kid='k1')
+
+    token = jwt.encode({'sub': 'abc'}, keyring.signing_key(), algorithm,
+                       headers={'kid': keyring.active_kid})
+    kid = jwt.get_unverified_header(token)['kid']
+    assert jwt.decode(token, keyring.verifying_key(kid), algorithms=[algorithm])['sub'] == 'abc'
+
+    jwks = keyring.jwks()
+    assert [key['kid'] for key in jwks['keys']] == ['k1', 'k2']
+    public_key = jwt.PyJWK(jwks['keys'][0]).key
+    assert jwt.decode(token, public_key, algorithms=[algorithm])['sub'] == 'abc'
+
+
+def test_keyring_unknown_kid(tmp_path):
+    write_key(str(tmp_path / 'k1.pem'), generate_key('RS256'))
+    keyring = KeyRing(str(tmp_path))
+    assert keyring.active_kid == 'k1'
+    with pytest.raises(jwt.InvalidTokenError):
+        keyring.verifying_key('k0')
+    with pytest.raises(ValueError):
+        KeyRing(str(tmp_path), active_kid='k0')
+
+
+def test_keyring_validate(tmp_path):
+    with pytest.raises(ValueError):
+        KeyRing(str(tmp_path / 'missing'))
+    with pytest.raises(ValueError):
+        KeyRing(str(tmp_path)).validate()
+    write_key(str(tmp_path / 'k1.pem'), generate_key('ES256'))
+    KeyRing(str(tmp_path), algorithm='ES256').validate()
+    with pytest.raises(ValueError):
+        KeyRing(str(tmp_path), algorithm='RS256').validate()
+
+
+def test_generate_signing_key_bootstraps_empty_dir(tmp_path):
+    import os
+    import subprocess
+    import sys
+
+    keys_dir = str(tmp_path / 'keys')
+    env = dict(os.environ, FLASK_APP='main.py', CONFIG_ENV='config.TestConfig',
+               JWT_ALGORITHM='ES256', JWT_KEYS_DIR=keys_dir)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # the app imports without any keys, they are only loaded by workers
+    result = subprocess.run([sys.executable, '-m', 'flask', 'generate-signing-key', '--kid', 'k1'],
+                            cwd=root, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    KeyRing(keys_dir, algorithm='ES256').validate()
@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+import uuid
+
+import pytest
+
+from main import db
+from api.v1.revocation import (
+    MemoryRevocationBackend, SQLRevocationBackend, SQLiteRevocationBackend, create_backend
+)
+
+
+@pytest.fixture(params=['sql', 'memory', 'sqlite'])
+def backend_factory(request, tmp_path):
+    """Builds a backend of each kind, ``denylist`` as for RevocationBackend"""
+    if request.param == 'memory':
+        yield MemoryRevocationBackend
+    elif request.param == 'sqlite':
+        path = str(tmp_path / 'revocations.db')
+        yield lambda denylist=None: SQLiteRevocationBackend(path, denylist=denylist)
+    else:
+        from models.revocation_events import RevocationEvent
+        from models.tokens import Token
+
+        db.create_all()
+        yield SQLRevocationBackend
+        db.session.rollback()
+        Token.query.filter(Token.user_uuid == 'backend_user').delete(synchronize_session=False)
+        RevocationEvent.query.filter(RevocationEvent.user_uuid == 'backend_user') \
+                             .delete(synchronize_session=False)
+        db.session.commit()
+
+
+def record(expires_in=60):
+    return {
+        'jti': str(uuid.uuid4()),
+        'token_type': 'access',
+        'user_uuid': 'backend_user',
+        'expires': datetime.now().replace(microsecond=0) + timedelta(seconds=expires_in),
+        'revoked': False,
+    }
+
+
+def test_backend_add_and_revoke(backend_factory):
+    backend = backend_factory()
+    issued, other = record(), record()
+    backend.add([issued, other])
+    assert backend.is_revoked(issued['jti']) is False
+    assert backend.is_revoked('missing') is None
+
+    assert backend.revoke(issued['jti'], 'backend_user') == issued['expires']
+    assert backend.is_revoked(issued['jti']) is True
+    assert backend.is_revoked_many([issued['jti'], other['jti'], 'missing']) == \
+        {issued['jti']: True, other['jti']: False}
+    revocations = dict(backend.revocations())
+    assert issued['jti'] in revocations and other['jti'] not in revocations
+
+    # unknown jtis are stored revoked when their expiry is known
+    unknown = record()
+    assert backend.revoke(unknown['jti'], 'backend_user', token_type='access',
+                          expires=unknown['expires']) == unknown['expires']
+    assert backend.is_revoked(unknown['jti']) is True
+    with pytest.raises(Exception):
+        backend.revoke('missing', 'backend_user')
+
+    many = [record(), record()]
+    backend.add(many[:1])
+    backend.revoke_many(many)
+    assert backend.is_revoked_many([r['jti'] for r in many]) == {r['jti']: True for r in many}
+
+
+def test_backend_purge_expired(backend_factory):
+    backend = backend_factory()
+    expired, valid = record(expires_in=-60), record()
+    backend.add([expired, valid])
+    backend.revoke(expired['jti'], 'backend_user')
+    assert backend.purge_expired(dry_run=True) >= 1
+    assert backend.is_revoked(expired['jti']) is True
+    assert backend.purge_expired(chunk_size=1, pause=0) >= 1
+    assert backend.is_revoked(expired['jti']) is None
+    assert backend.is_revoked(valid['jti']) is False
+    assert expired['jti'] not in dict(backend.revocations())
+
+
+def test_backend_denylist_keeps_revoked_only(backend_factory):
+    backend = backend_factory(denylist=lambda: True)
+    issued = record()
+    backend.add([issued])
+    assert backend.is_revoked(issued['jti']) is None
+    backend.revoke(issued['jti'], 'backend_user', token_type='access', expires=issued['expires'])
+    assert backend.is_revoked(issued['jti']) is True
+    # a miss means valid here, so it is never answered from a lagging copy
+    assert not backend.may_be_stale('backend_user')
+
+
+def test_create_backend(tmp_path):
+    assert isinstance(create_backend({'REVOCATION_BACKEND': 'memory'}), MemoryRevocationBackend)
+    assert isinstance(create_backend({}), SQLRevocationBackend)
+    backend = create_backend({'REVOCATION_BACKEND': 'sqlite',
+                              'REVOCATION_SQLITE_PATH': str(tmp_path / 'revocations.db')})
+    assert isinstance(backend, SQLiteRevocationBackend)
+    with pytest.raises(ValueError):
+        create_backend({'REVOCATION_BACKEND': 'redis'})
@@ -0,0 +1,97 @@
+import multiprocessing
+import time
+import uuid
+
+from api.v1.shm import SharedRevocationSet
+
+
+def test_shared_set_add_and_expire(tmp_path):
+    revocations = SharedRevocationSet(str(tmp_path / 'revocations'), slots=64)
+    jti = str(uuid.uuid4())
+    assert not revocations.contains(jti)
+    assert revocations.add(jti, time.time() + 60)
+    assert revocations.contains(jti)
+    assert not revocations.contains(jti, now=time.time() + 120)
+    assert revocations.add('not-a-uuid', time.time() + 60)
+    assert revocations.contains('not-a-uuid')
+    assert revocations.stats()['used'] == 2
+
+
+def _revoke(path, jti, exp):
+    SharedRevocationSet(path, slots=64).add(jti, exp)
+
+
+def test_shared_set_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / 'revocations')
+    revocations = SharedRevocationSet(path, slots=64)
+    jti = str(uuid.uuid4())
+    assert not revocations.contains(jti)
+
+    process = multiprocessing.get_context('fork').Process(
+        target=_revoke, args=(path, jti, time.time() + 60))
+    process.start()
+    process.join()
+    assert revocations.contains(jti)
+
+
+def test_shared_set_full_and_compaction(tmp_path):
+    revocations = SharedRevocationSet(str(tmp_path / 'revocations'), slots=8)
+    now = time.time()
+    jtis = [str(uuid.uuid4()) for _ in range(8)]
+    assert revocations.add_many([(jti, now + 60) for jti in jtis[:6]]) == 0
+    assert revocations.add(jtis[6], now + 60) is False
+    assert revocations.stats()['used'] == 6
+
+    # past their exp the entries make room again
+    assert revocations.add_many([(jtis[6], now + 120), (jtis[7], now + 120)], now=now + 90) == 0
+    assert revocations.contains(jtis[6], now=now + 90)
+    assert revocations.contains(jtis[7], now=now + 90)
+    assert not revocations.contains(jtis[0], now=now + 90)
+    assert revocations.stats()['used'] <= 6
+
+
+def test_shared_set_full_compacts_only_once_expired(tmp_path, monkeypatch):
+    revocations = SharedRevocationSet(str(tmp_path / 'revocations'), slots=8)
+    now = int(time.time())
+    assert revocations.add_many([(str(uuid.uuid4()), now + 60 + i) for i in range(6)]) == 0
+    compactions = []
+    compact = revocations._compact
+    monkeypatch.setattr(revocations, '_compact',
+                        lambda buf, now: compactions.append(now) or compact(buf, now))
+
+    # nothing has expired, so a rebuild could not free a slot
+    assert revocations.add_many([(str(uuid.uuid4()), now + 120) for _ in range(3)]) == 3
+    assert compactions == []
+
+    # the first entry has expired: one rebuild, which makes room for one
+    later = now + 60.5
+    assert revocations.add_many([(str(uuid.uuid4()), later + 120) for _ in range(3)], now=later) == 2
+    assert compactions == [later]
+    assert revocations.stats()['used'] == 6
+
+
+def test_shared_set_warms_once(tmp_path):
+    path = str(tmp_path / 'revocations')
+    jti = str(uuid.uuid4())
+    revocations = SharedRevocationSet(path, slots=64)
+    assert not revocations.complete()
+    assert revocations.warm(lambda: [(jti, time.time() + 60)])
+    assert revocations.complete()
+
+    other_worker = SharedRevocationSet(path, slots=64)
+    assert other_worker.warm(lambda: 1 / 0) is False
+    assert other_worker.contains(jti)
+
+
+def test_shared_set_repairs_interrupted_rebuild(tmp_path):
+    from api.v1.shm import HEADER
+
+    revocations = SharedRevocationSet(str(tmp_path / 'revocations'), slots=8)
+    jti = str(uuid.uuid4())
+    revocations.warm(lambda: [(jti, time.time() + 60)])
+    buf = revocations._mapping()
+    magic, slots, complete, used, generation, min_exp = HEADER.unpack_from(buf, 0)
+    HEADER.pack_into(buf, 0, magic, slots, complete, used, generation + 1, min_exp)
+
+    assert not revocations.contains(jti)
+    assert not revocations.complete()
@@ -0,0 +1,62 @@
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from api.v1.write_behind import TokenWriter
+
+
+def records(*jtis):
+    return [{'jti': jti} for jti in jtis]
+
+
+def test_flushes_on_size_and_time():
+    written = []
+    writer = TokenWriter(written.append, batch_size=3, interval=0.05)
+    writer.submit(records('a', 'b'))
+    assert writer.is_pending('a')
+    deadline = time.time() + 5
+    while writer.is_pending('a') and time.time() < deadline:
+        time.sleep(0.01)
+    assert written == [records('a', 'b')]
+
+    writer.interval = 60
+    writer.submit(records('c', 'd', 'e'))
+    deadline = time.time() + 5
+    while len(writer) and time.time() < deadline:
+        time.sleep(0.01)
+    assert written[1] == records('c', 'd', 'e')
+    writer.close()
+
+
+def test_backpressure_flushes_inline_and_close_flushes():
+    written = []
+
+    def write(rows):
+        written.extend(row['jti'] for row in rows)
+
+    writer = TokenWriter(write, max_size=2, batch_size=10, interval=60, put_timeout=0.01)
+    writer.submit(records('a', 'b'))
+    # the queue is full: after put_timeout the caller writes everything itself
+    writer.submit(records('c'))
+    assert written == ['a', 'b', 'c']
+    assert len(writer) == 0
+
+    writer.submit(records('d'))
+    assert writer.close() == 1
+    assert written[-1] == 'd'
+
+
+def test_integrity_error_writes_rows_one_by_one():
+    written = []
+
+    def write(rows):
+        if any(row['jti'] == 'dup' for row in rows):
+            raise IntegrityError('insert', {}, Exception('duplicate'))
+        written.extend(row['jti'] for row in rows)
+
+    writer = TokenWriter(write, batch_size=10, interval=60)
+    writer.submit(records('a', 'dup', 'b'))
+    assert writer.flush() == 3
+    assert written == ['a', 'b']
+    assert not writer.is_pending('dup')
+    writer.close()
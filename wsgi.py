@@ -2,6 +2,9 @@ from dotenv import load_dotenv
 load_dotenv('.env')
 
 from main import app
+from api.v1.keys import load_keyring
+
+load_keyring()
 
 if __name__ == '__main__':
     app.run()